@@ -6,9 +6,18 @@ Some of this code borrows from David's github repository: https://github.com/dav
 
 import numpy as np
 import FluorSpec.PTI_Data
-import matplotlib.pyplot as plt
-import time
+import FluorSpec.Cache
+import FluorSpec.Regrid
+import FluorSpec.Diagnostics
+import FluorSpec.Metrics
+from FluorSpec.Metrics import Timed
 import os
+import logging
+from collections import OrderedDict
+import concurrent.futures
+import fnmatch
+
+_log = logging.getLogger(__name__)
 
 class FluorSpecReader():
     '''
@@ -25,20 +34,155 @@ class FluorSpecReader():
 
     Basepath = 'C:\\Users\\lbignell\\Documents\\GitHub\\FluorSpec\\'
 
-    def __init__(self):
-        print("Initializing FluorSpecReader at {0}".format(time.asctime(time.localtime())))
-        pass
+    def __init__(self, corrcachesize=8, interpcachesize=64, regridcachesize=32,
+                 diagnostics=None):
+        '''
+        Optionally set the number of parsed correction files, of
+        interpolated correction vectors and of regridding weight matrices
+        that are kept in memory.
+
+        diagnostics is an optional Diagnostics.DiagnosticsRecorder. If it is
+        given, the diagnostic plots asked for (with MakePlots or verbose) are
+        recorded there to be rendered later, instead of being drawn with
+        pyplot. A recorder with RecordAll set gets the plots of every call.
+        '''
+        _log.debug("Initializing FluorSpecReader")
+        #Parsed correction files, keyed by (key, mtime, size) of the file.
+        self.CorrDataCache = FluorSpec.Cache.LRUCache(corrcachesize)
+        #Correction vectors interpolated onto a data WL grid, keyed by
+        #(key, mtime, size, grid fingerprint).
+        self.CorrValsCache = FluorSpec.Cache.LRUCache(interpcachesize)
+        #Resamples spectra on other grids (e.g. the solvent and dilute spectra
+        #in the QY calculations) onto the grid they're compared with.
+        self.Regridder = FluorSpec.Regrid.Regridder(regridcachesize)
+        self.Diagnostics = diagnostics
 
     def GetCorrData(self, key):
         '''
         Return spectral correction data object.
         
         key may be: 'emcorri', 'emcorr-sphere', 'emcorr-sphere-quanta', or 'excorr'.
+        The parsed files are cached and re-read only if their mtime or size
+        change; the returned object is shared, so don't modify it.
+        '''
+        entry = self._GetCorrEntry(key)
+        if entry is None:
+            return
+        return entry[1]
+
+    def GetCorrVals(self, key, WL):
+        '''
+        Return the correction data object for key and the correction
+        interpolated onto the wavelengths WL (zero outside its range).
+
+        The interpolated vector is cached per (key, WL grid) and is read-only.
+        Returns (None, None) if the correction data can't be loaded.
+        '''
+        entry = self._GetCorrEntry(key)
+        if entry is None:
+            return None, None
+        stamp, corr = entry
+        cachekey = stamp + FluorSpec.Cache.GridFingerprint(WL)
+        CorrVals = self.CorrValsCache.Get(cachekey)
+        if CorrVals is None:
+            with FluorSpec.Metrics.Stage('interpolation'):
+                CorrVals = np.interp(WL, corr.WL, corr.Trace, left=0, right=0)
+            CorrVals.setflags(write=False)
+            self.CorrValsCache.Put(cachekey, CorrVals)
+        return corr, CorrVals
+
+    def CacheStats(self):
+        '''
+        Return the hit/miss/eviction counts of the correction caches.
+        '''
+        return {'CorrData':self.CorrDataCache.Stats(),
+                'CorrVals':self.CorrValsCache.Stats()}
+
+    def ClearCache(self):
+        '''
+        Empty the correction caches (the statistics are kept).
+        '''
+        self.CorrDataCache.Clear()
+        self.CorrValsCache.Clear()
+
+    def _GetCorrEntry(self, key):
+        '''
+        Return ((key, mtime, size), PTI_Data) for a correction file, from the
+        cache if the file hasn't changed since it was parsed.
         '''
         if key not in self.CorrFiles:
-            print('ERROR!! Incorrect choice of correction file.')
+            _log.error('ERROR!! Incorrect choice of correction file.')
+            return
+        path = self.Basepath + self.CorrFiles[key]
+        try:
+            st = os.stat(path)
+        except OSError:
+            _log.error('ERROR!! Correction file %s does not exist.', path)
             return
-        return FluorSpec.PTI_Data.PTI_Data(self.Basepath + self.CorrFiles[key])
+        stamp = (key, st.st_mtime, st.st_size)
+        corr = self.CorrDataCache.Get(stamp)
+        if corr is None:
+            with FluorSpec.Metrics.Stage('corr_file_load'):
+                corr = FluorSpec.PTI_Data.PTI_Data(path)
+            if not corr.SuccessfullyRead:
+                return
+            self.CorrDataCache.Put(stamp, corr)
+        else:
+            FluorSpec.Metrics.Count('corr_cache_hits')
+        return stamp, corr
+
+    def _WantPlots(self, flag):
+        return flag or (self.Diagnostics is not None and self.Diagnostics.RecordAll)
+
+    def _Plot(self, figure):
+        '''
+        Record a DiagnosticFigure, or draw it now if there's no recorder.
+        '''
+        if self.Diagnostics is not None:
+            self.Diagnostics.Record(figure)
+        else:
+            FluorSpec.Diagnostics.ShowFigure(figure)
+
+    def ReadDirectory(self, path, pattern='*.txt', recursive=False, workers=None,
+                      usethreads=False, chunksize=16, lazy=False, quiet=True,
+                      compact=None):
+        '''
+        Read all the PTI exports in a directory, in parallel.
+
+        Arguments:
+        - the directory, and a filename pattern to match.
+        - whether to also look in subdirectories.
+        - the number of workers (default: number of CPUs), and whether to use
+          threads rather than processes. Files are handed to the workers in
+          chunks of chunksize.
+        - lazy and quiet are passed on to PTI_Data.
+        - if compact is a dtype (e.g. np.float32), CompactPTI_Data objects with
+          that dtype are returned instead (made in the workers).
+
+        Returns a list of the PTI_Data objects that were read successfully, in
+        sorted path order, and a list of (path, messages) for those that weren't.
+        '''
+        paths = _FindFiles(path, pattern, recursive)
+        chunks = [paths[i:i+chunksize] for i in range(0, len(paths), chunksize)]
+        if usethreads:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        datalist = []
+        failures = []
+        with executor:
+            #map returns the results in the order the chunks were submitted.
+            for results in executor.map(_ReadFiles, chunks, [lazy]*len(chunks),
+                                        [quiet]*len(chunks), [compact]*len(chunks)):
+                for fname, data, messages in results:
+                    if data is None:
+                        failures.append((fname, messages))
+                    else:
+                        datalist.append(data)
+        if not quiet and failures:
+            _log.error('ERROR!! %d of %d files could not be read.',
+                       len(failures), len(paths))
+        return datalist, failures
 
     def ApplyEmCorrFileToCorr(self, data, corrx, corry):
         '''
@@ -46,6 +190,7 @@ class FluorSpecReader():
         '''
         pass
 
+    @Timed('correction')
     def ApplyCorrFileToRaw(self, data, key, bckgnd=0, extracorr=None, 
                            MakePlots=False, factor=None, crashonerror=True):
         '''
@@ -62,73 +207,131 @@ class FluorSpecReader():
         *factor* optionally applies a multiplicative factor to the data (for comparing data with different 
         integration times or sensitivities).
         '''
-        if data.FileType.value > 2:
-            rawspec = data.Trace
-            uspec = data.UTrace
-        elif data.FileType.value == 2:
-            rawspec = data.SpecRaw
-            uspec = data.USpecRaw
-        else:
-            print("Analyse.ApplyCorrFileToRaw ERROR!! Bad file")
+        rawspec, uspec = _RawSpec(data)
+        if rawspec is None:
+            _log.error("Analyse.ApplyCorrFileToRaw ERROR!! Bad file")
             return
-        CorrData = None
-        if factor is not None:
-            rawspec = np.multiply(rawspec, factor)
-            bckgnd = np.multiply(bckgnd, factor)
-        if key is not 'default':
-            corr = self.GetCorrData(key)
+        plan = self.MakeCorrectionPlan(data, key, bckgnd=bckgnd,
+                                       extracorr=extracorr, factor=factor,
+                                       crashonerror=crashonerror)
+        if plan is None:
+            return
+        CorrData, UCorrData = plan.Apply(rawspec, uspec)
+        if self._WantPlots(MakePlots):
+            if factor is not None:
+                rawspec = np.multiply(rawspec, factor)
+            #Plot the raw data.
+            fig = FluorSpec.Diagnostics.DiagnosticFigure(
+                'correction_' + _BaseName(data), legend={})
+            fig.Add('plot', data.WL, rawspec, label='Raw Data')
+            fig.Add('plot', data.WL, CorrData, label='Corrected using {0}'.format(key))
+            if extracorr is not None:
+                fig.Add('plot', data.WL, CorrData,
+                        label='Corrected with Sync Scan file {0}'.format(
+                        extracorr.FilePath))
+            self._Plot(fig)
+        data.RegisterCorrSpec(CorrData,UCorrData)
+        return CorrData, UCorrData
+    
+    def MakeCorrectionPlan(self, data, key, bckgnd=0, extracorr=None,
+                           factor=None, crashonerror=True):
+        '''
+        Build a CorrectionPlan for spectra on the same WL grid as data.
+
+        The arguments are the same as for ApplyCorrFileToRaw; data is only
+        used for its WL grid and run type. Returns None if the correction
+        can't be made.
+        '''
+        return self._MakePlan(data.WL, data.RunType, key, bckgnd=bckgnd,
+                              extracorr=extracorr, factor=factor,
+                              crashonerror=crashonerror)
+
+    @Timed('correction_batch')
+    def ApplyCorrFileToRawBatch(self, datalist, key, bckgnd=0, extracorr=None,
+                                factor=None, register=True, crashonerror=True):
+        '''
+        Correct many PTI_Data objects at once.
+
+        The spectra are grouped by WL grid and run type, and each group is
+        corrected as a single 2-D array operation. The other arguments are as for
+        ApplyCorrFileToRaw (bckgnd and factor are shared by all spectra).
+        If register is True the corrected spectra are registered on each
+        object (as rows of the returned arrays, not copies).
+
+        Returns a list with one (indices, WL, CorrData, UCorrData) tuple per
+        group, where indices are the positions in datalist of the rows of the
+        N x M arrays CorrData and UCorrData. Bad files are left out.
+        '''
+        groups = OrderedDict()
+        for i, data in enumerate(datalist):
+            if _RawSpec(data)[0] is None:
+                _log.error("Analyse.ApplyCorrFileToRawBatch ERROR!! Bad file %s",
+                           getattr(data, 'FilePath', i))
+                continue
+            #Group by run type too, so that each spectrum gets the same run
+            #type check as in ApplyCorrFileToRaw.
+            groups.setdefault((FluorSpec.Cache.GridFingerprint(data.WL),
+                               getattr(data, 'RunType', None)), []).append(i)
+        results = []
+        for indices in groups.values():
+            template = datalist[indices[0]]
+            plan = self.MakeCorrectionPlan(template, key, bckgnd=bckgnd,
+                                           extracorr=extracorr, factor=factor,
+                                           crashonerror=crashonerror)
+            if plan is None:
+                continue
+            specs = [_RawSpec(datalist[i]) for i in indices]
+            CorrData, UCorrData = plan.Apply(np.array([s[0] for s in specs], dtype=float),
+                                             np.array([s[1] for s in specs], dtype=float))
+            if register:
+                for row, i in enumerate(indices):
+                    datalist[i].RegisterCorrSpec(CorrData[row], UCorrData[row])
+            results.append((indices, plan.WL, CorrData, UCorrData))
+        return results
+
+    def CorrectSpectra(self, rawspec, WL, key, uspec=None, RunType=None,
+                       bckgnd=0, extracorr=None, factor=None, crashonerror=True):
+        '''
+        Correct an N x M array of raw spectra that share the wavelengths WL.
+
+        uspec defaults to sqrt(|rawspec|), as for the data read from file.
+        If RunType (a PTI_Data.RunTypes value) is given it is checked against
+        the correction file. bckgnd and factor may be scalars, M vectors or
+        N x M arrays; the other arguments are as for ApplyCorrFileToRaw.
+        Returns the N x M corrected spectra and uncertainties.
+        '''
+        rawspec = np.asarray(rawspec, dtype=float)
+        if uspec is None:
+            uspec = np.sqrt(np.abs(rawspec))
+        plan = self._MakePlan(WL, RunType, key, bckgnd=bckgnd,
+                              extracorr=extracorr, factor=factor,
+                              crashonerror=crashonerror)
+        if plan is None:
+            return
+        return plan.Apply(rawspec, uspec)
+
+    def _MakePlan(self, WL, RunType, key, bckgnd=0, extracorr=None,
+                  factor=None, crashonerror=True):
+        CorrVals = None
+        if key != 'default':
+            corr, CorrVals = self.GetCorrVals(key, WL)
             if corr is None:
-                print('Not correcting data.')
+                _log.warning('Not correcting data.')
                 return
-            if data.RunType.value!=corr.RunType.value:
-                print('ERROR!! The correction type doesn\'t match the data type.')
-                print('Correction type = {0}, data type = {1}'
-                        .format(corr.RunType, data.RunType))
+            if RunType is not None and RunType.value!=corr.RunType.value:
+                _log.error('ERROR!! The correction type doesn\'t match the data type. '
+                           'Correction type = %s, data type = %s', corr.RunType, RunType)
                 if crashonerror:
                     return
-            CorrVals = np.interp(data.WL, corr.WL, corr.Trace, left=0, right=0)
-        else:
-            CorrVals = [1 for i in len(rawspec)]
-
-        CorrData = np.multiply(np.subtract(rawspec, bckgnd),
-                               CorrVals)
-        Ubckgnd = np.sqrt(bckgnd)
-        UCorrData = np.multiply(np.sqrt(np.add(np.power(uspec,2),
-                                               np.power(Ubckgnd,2))),
-                                CorrVals)
-        if MakePlots and extracorr is None:
-            #Plot the raw data.
-            plt.figure()
-            plt.plot(data.WL, rawspec, label='Raw Data')
-            plt.plot(data.WL, CorrData, label='Corrected using {0}'.format(key))
-            plt.legend()
-
         if extracorr is not None:
             if extracorr.RunType.name!='Synchronous':
-                print('ERROR!! The extracorr run type is not synchronous!')
+                _log.error('ERROR!! The extracorr run type is not synchronous!')
                 if crashonerror:
                     return
-            #The mess below corrects for the measured difference between the sphere
-            #response and the file correction, as well as its uncertainty.
-            extracorr_vals = np.interp(data.WL, extracorr.WL, extracorr.Spec)
-            CorrData_extracorr = np.divide(CorrData,extracorr_vals)
-            Raw_extracorr = np.interp(data.WL, extracorr.WL, extracorr.SpecRaw)
-            URaw_extracorr = np.sqrt(Raw_extracorr)
-            Uextracorr = np.multiply(extracorr_vals,np.divide(URaw_extracorr, Raw_extracorr))
-            UCorrData = np.sqrt(np.add(np.power(np.multiply(np.divide(1,extracorr_vals), UCorrData),2),
-                               np.power(np.multiply(np.divide(CorrData_extracorr,extracorr_vals), Uextracorr),2)))
-            CorrData = CorrData_extracorr
-            if MakePlots:
-                plt.figure()
-                plt.plot(data.WL, rawspec, label='Raw Data')
-                plt.plot(data.WL, CorrData, label='Corrected using {0}'.format(key))
-                plt.plot(data.WL, CorrData,
-                         label='Corrected with Sync Scan file {0}'.format(
-                         extracorr.FilePath))
-                plt.legend()
-        data.RegisterCorrSpec(CorrData,UCorrData)
-        return CorrData, UCorrData
-    
+        return CorrectionPlan(WL, CorrVals, bckgnd=bckgnd,
+                              extracorr=extracorr, factor=factor)
+
+    @Timed('qy')
     def CalculateQY_2MM(self, fluor, solvent, scat_start, scat_end, em_start, em_end, use_solvent_BL=False,
                         dilute=None, normWL=None, verbose=False, avglen=4):
         '''
@@ -140,16 +343,17 @@ class FluorSpecReader():
         Arguments:
         - the PTI_Data objects for the fluorophore and solvent. Note that the correction has to be registered.
         - the integration ranges for the scatter peak and emission spectrum.
-        - optionally use the solvent spectrum for the fluorescence baseline corr.
+        - optionally use the solvent spectrum for the fluorescence baseline corr
+          (it's resampled onto the fluor WL grid if they differ).
         - corrected spectrum and PTI_Data object for a dilute fluor spec (for reabsorption correction).
         - flag to print info to console and create a plot.
         '''
-        ScatStartIdx_Solvent = solvent.WL.index(np.interp(scat_start, solvent.WL, solvent.WL))
-        ScatEndIdx_Solvent = solvent.WL.index(np.interp(scat_end, solvent.WL, solvent.WL))
-        ScatStartIdx_Fluor = fluor.WL.index(np.interp(scat_start, fluor.WL, fluor.WL))
-        ScatEndIdx_Fluor = fluor.WL.index(np.interp(scat_end, fluor.WL, fluor.WL))
-        EmStartIdx_Fluor = fluor.WL.index(np.interp(em_start, fluor.WL, fluor.WL))
-        EmEndIdx_Fluor = fluor.WL.index(np.interp(em_end, fluor.WL, fluor.WL))
+        ScatStartIdx_Solvent = _WLIndex(solvent.WL, scat_start)
+        ScatEndIdx_Solvent = _WLIndex(solvent.WL, scat_end)
+        ScatStartIdx_Fluor = _WLIndex(fluor.WL, scat_start)
+        ScatEndIdx_Fluor = _WLIndex(fluor.WL, scat_end)
+        EmStartIdx_Fluor = _WLIndex(fluor.WL, em_start)
+        EmEndIdx_Fluor = _WLIndex(fluor.WL, em_end)
         #Calculate baselines
         Scat_BL_Fluor = self.CalcStraightLine(fluor.WL,
                                               fluor.SpecCorrected,
@@ -162,8 +366,8 @@ class FluorSpecReader():
                                               ScatEndIdx_Solvent,
                                               avglen=avglen)
         if use_solvent_BL:
-            #do it assuming same WL range for now.
-            Em_BL_Fluor = solvent.SpecCorrected
+            Em_BL_Fluor = self.Regridder.Regrid(solvent.WL, fluor.WL,
+                                                solvent.SpecCorrected)[0]
         else:
             Em_BL_Fluor = self.CalcStraightLine(fluor.WL,
                                                 fluor.SpecCorrected,
@@ -171,71 +375,309 @@ class FluorSpecReader():
                                                 EmEndIdx_Fluor,
                                                 avglen=avglen)
 
-        N_emitted = sum(np.subtract(fluor.SpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],
+        N_emitted = np.sum(np.subtract(fluor.SpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],
                                     Em_BL_Fluor[EmStartIdx_Fluor:EmEndIdx_Fluor]))
-        UN_emitted = np.sqrt(sum(np.power(fluor.USpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],2)))
-        N_Tot_empty = sum(np.subtract(solvent.SpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],
+        UN_emitted = np.sqrt(np.sum(np.power(fluor.USpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],2)))
+        N_Tot_empty = np.sum(np.subtract(solvent.SpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],
                                       Scat_BL_Solvent[ScatStartIdx_Solvent:ScatEndIdx_Solvent]))
-        UN_Tot_empty = np.sqrt(sum(np.power(solvent.USpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],2)))
-        N_Tot_sample = sum(np.subtract(fluor.SpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],
+        UN_Tot_empty = np.sqrt(np.sum(np.power(solvent.USpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],2)))
+        N_Tot_sample = np.sum(np.subtract(fluor.SpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],
                                        Scat_BL_Fluor[ScatStartIdx_Fluor:ScatEndIdx_Fluor]))
-        UN_Tot_sample = np.sqrt(sum(np.power(fluor.USpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],2)))
+        UN_Tot_sample = np.sqrt(np.sum(np.power(fluor.USpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],2)))
         if((dilute is not None)) and (normWL is not None):
             if dilute.SpecCorrected is not None:
                 w, Uw = self.CalcReabsProb(fluor, em_start, em_end,
-                                           dilute.WL.index(np.interp(normWL, dilute.WL, dilute.WL)),
+                                           _WLIndex(fluor.WL, normWL),
                                            Em_BL_Fluor, dilute, verbose)
         else:
             w = 0
             Uw = 0
 
-        QY = N_emitted/(N_Tot_empty - N_Tot_sample)
-        UQY = np.sqrt((1/(N_Tot_empty-N_Tot_sample)**2)*(UN_emitted**2) + 
-                      ((QY/(N_Tot_empty-N_Tot_sample))**2)*(UN_Tot_empty**2 + UN_Tot_sample**2))
-        QY_w = QY/(1- w + w*QY)
-        UQY = np.sqrt(((QY_w/QY)**2)*(UQY**2) +
-                      (((1-QY)*QY_w/(1-w+w*QY))**2)*(Uw**2))
-        QY = QY_w
+        QY, UQY = _QYFromSums(N_emitted, UN_emitted, N_Tot_empty, UN_Tot_empty,
+                              N_Tot_sample, UN_Tot_sample, w, Uw)
         if verbose:
             print("Quantum Yield: \n # emitted = {0} +/- {1}, \
             # tot (no sample) = {2} +/- {3}, \
             # tot (sample) = {4} +/- {5}, \
             QY = {6} +/- {7}".format(
                 N_emitted, UN_emitted, N_Tot_empty, UN_Tot_empty, N_Tot_sample, UN_Tot_sample, QY, UQY))
-            plt.figure()        
-            plt.errorbar(fluor.WL, fluor.SpecCorrected, yerr=fluor.USpecCorrected, color='b', label='fluor spec')
-            plt.errorbar(solvent.WL, solvent.SpecCorrected, yerr=solvent.USpecCorrected, color='r', label='solvent spec')
-            plt.plot(fluor.WL, Scat_BL_Fluor, 'g', label='fluor scattering baseline')
-            plt.plot(fluor.WL, Em_BL_Fluor, 'c', label='fluor emission baseline')
-            plt.plot(solvent.WL, Scat_BL_Solvent, 'm', label='solvent scattering baseline')
-            plt.legend()
-            plt.xlabel('Wavelength (nm)')
-            plt.ylabel('Fluorescence Intensity (AU)')
-            plt.title('file: ' + str(fluor.FilePath.split('\\')[-1]) +
-                '\n Excitation' + str(fluor.ExRange) +
-                ' nm, Emission ' + str(fluor.EmRange) + ' nm')
-            plt.figure()
-            plt.errorbar(solvent.WL[ScatStartIdx_Solvent:ScatEndIdx_Solvent], np.subtract(solvent.SpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],
+        if self._WantPlots(verbose):
+            fig = FluorSpec.Diagnostics.DiagnosticFigure(
+                'qy_' + _BaseName(fluor), title=_PlotTitle(fluor),
+                xlabel='Wavelength (nm)', ylabel='Fluorescence Intensity (AU)',
+                legend={})
+            fig.Add('errorbar', fluor.WL, fluor.SpecCorrected, yerr=fluor.USpecCorrected, color='b', label='fluor spec')
+            fig.Add('errorbar', solvent.WL, solvent.SpecCorrected, yerr=solvent.USpecCorrected, color='r', label='solvent spec')
+            fig.Add('plot', fluor.WL, Scat_BL_Fluor, 'g', label='fluor scattering baseline')
+            fig.Add('plot', fluor.WL, Em_BL_Fluor, 'c', label='fluor emission baseline')
+            fig.Add('plot', solvent.WL, Scat_BL_Solvent, 'm', label='solvent scattering baseline')
+            self._Plot(fig)
+            fig = FluorSpec.Diagnostics.DiagnosticFigure(
+                'qy_windows_' + _BaseName(fluor), title=_PlotTitle(fluor),
+                xlabel='Wavelength (nm)', ylabel='Fluorescence Intensity (AU)',
+                legend={})
+            fig.Add('errorbar', solvent.WL[ScatStartIdx_Solvent:ScatEndIdx_Solvent], np.subtract(solvent.SpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],
                                                                                           Scat_BL_Solvent[ScatStartIdx_Solvent:ScatEndIdx_Solvent]),
-                         yerr=solvent.USpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],
-                         color='r', label='solvent spec')
-            plt.errorbar(fluor.WL[ScatStartIdx_Fluor:ScatEndIdx_Fluor], np.subtract(fluor.SpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],
+                    yerr=solvent.USpecCorrected[ScatStartIdx_Solvent:ScatEndIdx_Solvent],
+                    color='r', label='solvent spec')
+            fig.Add('errorbar', fluor.WL[ScatStartIdx_Fluor:ScatEndIdx_Fluor], np.subtract(fluor.SpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],
                                                                                     Scat_BL_Fluor[ScatStartIdx_Fluor:ScatEndIdx_Fluor]),
-                         yerr=fluor.USpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],
-                         color='b', label='fluor spec, scatter')
-            plt.errorbar(fluor.WL[EmStartIdx_Fluor:EmEndIdx_Fluor], np.subtract(fluor.SpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],
+                    yerr=fluor.USpecCorrected[ScatStartIdx_Fluor:ScatEndIdx_Fluor],
+                    color='b', label='fluor spec, scatter')
+            fig.Add('errorbar', fluor.WL[EmStartIdx_Fluor:EmEndIdx_Fluor], np.subtract(fluor.SpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],
                                                                                 Em_BL_Fluor[EmStartIdx_Fluor:EmEndIdx_Fluor]),
-                         yerr=fluor.USpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],
-                         color='g', label='fluor spec, emission')
-            plt.plot((fluor.WL[ScatStartIdx_Fluor],fluor.WL[EmEndIdx_Fluor]), (0,0), 'k')
-            plt.legend()
-            plt.xlabel('Wavelength (nm)')
-            plt.ylabel('Fluorescence Intensity (AU)')
-            plt.title('file: ' + str(fluor.FilePath.split('\\')[-1]) +
-                '\n Excitation' + str(fluor.ExRange) +
-                ' nm, Emission ' + str(fluor.EmRange) + ' nm')
+                    yerr=fluor.USpecCorrected[EmStartIdx_Fluor:EmEndIdx_Fluor],
+                    color='g', label='fluor spec, emission')
+            fig.Add('plot', (fluor.WL[ScatStartIdx_Fluor],fluor.WL[EmEndIdx_Fluor]), (0,0), 'k')
+            self._Plot(fig)
+        return QY, UQY
+
+    @Timed('qy_batch')
+    def CalculateQY_2MM_Batch(self, fluors, solvents, scat_start, scat_end,
+                              em_start, em_end, use_solvent_BL=False,
+                              dilutes=None, normWL=None, avglen=4):
+        '''
+        Calculate QY using 2 measurement method for many samples at once.
+
+        Does the same calculation as CalculateQY_2MM for each fluor/solvent
+        pair, with the baselines, integrals, reabsorption correction and
+        uncertainties worked out as array operations over all the samples.
+
+        Arguments:
+        - lists of PTI_Data objects for the fluorophores and solvents (with
+          the correction registered).
+        - the integration ranges for the scatter peak and emission spectrum,
+          as scalars or one value per sample.
+        - optionally use the solvent spectrum for the fluorescence baseline.
+        - optionally a list of dilute PTI_Data objects (entries may be None)
+          and the normalisation wavelength(s) for the reabsorption correction.
+        - the number of points averaged at each end of the baselines.
+        Solvent baselines and dilute spectra on other WL grids are resampled
+        onto the fluor grids (see Regrid.Regridder).
+
+        Returns arrays of QY and UQY.
+        '''
+        N = len(fluors)
+        scat_start, scat_end, em_start, em_end = [
+            np.broadcast_to(np.asarray(x, dtype=float), (N,))
+            for x in (scat_start, scat_end, em_start, em_end)]
+        WL_F, F, UF, len_F = _StackCorrected(fluors)
+        WL_S, S, US, len_S = _StackCorrected(solvents)
+        FluorIdx = [_WLIndexRows(WL_F, len_F, x)
+                    for x in (scat_start, scat_end, em_start, em_end)]
+        SolventIdx = [_WLIndexRows(WL_S, len_S, x) for x in (scat_start, scat_end)]
+        Em_BL = None
+        if use_solvent_BL:
+            Em_BL = self.Regridder.RegridData(solvents, [f.WL for f in fluors])[0]
+        reabs = None
+        if dilutes is not None and normWL is not None:
+            normWL = np.broadcast_to(np.asarray(normWL, dtype=float), (N,))
+            rows = np.array([i for i, d in enumerate(dilutes)
+                             if d is not None and d.SpecCorrected is not None], dtype=int)
+            if len(rows) > 0:
+                D = self.Regridder.RegridData([dilutes[i] for i in rows],
+                                              [fluors[i].WL for i in rows])[0]
+                reabs = (rows, D, FluorIdx[2][rows], FluorIdx[3][rows],
+                         _WLIndexRows(WL_F[rows], len_F[rows], normWL[rows]))
+        QY, UQY, w, Uw = _QYStacks(WL_F, F, UF, len_F, WL_S, S, US, len_S,
+                                   FluorIdx, SolventIdx, avglen, Em_BL, reabs)
         return QY, UQY
 
+    def CalculateQY_2MM_MC(self, fluor, solvent, scat_start, scat_end, em_start,
+                           em_end, use_solvent_BL=False, dilute=None, normWL=None,
+                           avglen=4, replicas=10000, extracorr=None, corr_relunc=None,
+                           seed=None, percentiles=(2.5, 16, 50, 84, 97.5),
+                           chunksize=2000, return_samples=False):
+        '''
+        Calculate QY using 2 measurement method, with a Monte Carlo estimate
+        of its uncertainty.
+
+        Replicas of the corrected fluor, solvent and dilute spectra are drawn
+        and each goes through the same baseline fitting, integration and
+        reabsorption correction as in CalculateQY_2MM, so that correlations
+        (e.g. from the shared baselines) are accounted for.
+
+        The arguments are as for CalculateQY_2MM, plus:
+        - the number of replicas (drawn and processed chunksize at a time).
+        - the synchronous scan PTI_Data object used in the correction, if
+          any. Its uncertainty is taken out of USpecCorrected and drawn as a
+          multiplicative error shared by all the spectra in a replica.
+        - an optional relative uncertainty of the correction file, also
+          shared by all the spectra: a scalar (an overall scale error, the
+          same at every wavelength) or a (WL, relunc) pair (independent at
+          each of the WL points, and interpolated between them).
+        - a seed (or numpy Generator) for the random numbers.
+        - the percentiles of QY to report.
+
+        Returns a dict with the nominal QY and first order UQY, the mean,
+        standard deviation and percentiles of QY and the mean and standard
+        deviation of w over the replicas (and the QY of every replica, if
+        return_samples is True).
+        '''
+        rng = np.random.default_rng(seed)
+        spectra = [fluor, solvent]
+        usereabs = dilute is not None and normWL is not None and \
+                   dilute.SpecCorrected is not None
+        if usereabs:
+            spectra.append(dilute)
+        #Relative errors shared by every spectrum in a replica, as
+        #(WL, relative uncertainty) pairs; WL is None for a scale error.
+        shared = []
+        if extracorr is not None:
+            shared.append((np.asarray(extracorr.WL, dtype=float),
+                           np.divide(np.sqrt(extracorr.SpecRaw), extracorr.SpecRaw)))
+        if corr_relunc is not None:
+            if np.ndim(corr_relunc) == 0:
+                shared.append((None, float(corr_relunc)))
+            else:
+                shared.append(tuple(np.asarray(x, dtype=float) for x in corr_relunc))
+        means = []
+        sigmas = []
+        for data in spectra:
+            spec = np.asarray(data.SpecCorrected, dtype=float)
+            var = np.square(data.USpecCorrected)
+            if extracorr is not None:
+                Raw_extracorr = np.interp(data.WL, extracorr.WL, extracorr.SpecRaw)
+                var = var - np.square(spec*np.divide(np.sqrt(Raw_extracorr), Raw_extracorr))
+            means.append(spec)
+            sigmas.append(np.sqrt(np.clip(var, 0, None)))
+        #The dilute spectrum is compared with the fluor point by point, so
+        #draw its replicas on the fluor grid.
+        grids = [fluor.WL, solvent.WL, fluor.WL]
+        if usereabs:
+            means[2], sigmas[2] = self.Regridder.Regrid(dilute.WL, fluor.WL,
+                                                        means[2], sigmas[2])
+
+        scat_start, scat_end, em_start, em_end = [
+            np.array([x], dtype=float) for x in (scat_start, scat_end, em_start, em_end)]
+        def stack(data, k):
+            M = len(data.WL)
+            return np.broadcast_to(np.asarray(data.WL, dtype=float), (k, M)), np.full(k, M)
+        def indices(data, values, k):
+            return [np.full(k, _WLIndex(data.WL, x[0])) for x in values]
+
+        def run(k):
+            specs = []
+            #One draw of each shared error per replica, interpolated onto
+            #the grid of every spectrum.
+            draws = [rng.standard_normal((k, 1 if WL is None else len(WL)))*relunc
+                     for WL, relunc in shared]
+            fields = [field if WL is None else _InterpRows(grids[n], WL, field)
+                      for (WL, relunc), field in zip(shared, draws)
+                      for n in range(len(spectra))]
+            for n, data in enumerate(spectra):
+                spec = means[n] + sigmas[n]*rng.standard_normal((k, len(means[n])))
+                factor = 1
+                for field in fields[n::len(spectra)]:
+                    factor = factor + field
+                specs.append(spec*factor)
+            WL_F, len_F = stack(fluor, k)
+            WL_S, len_S = stack(solvent, k)
+            Em_BL = None
+            if use_solvent_BL:
+                Em_BL = self.Regridder.Regrid(solvent.WL, fluor.WL, specs[1])[0]
+            reabs = None
+            if usereabs:
+                reabs = (np.arange(k), specs[2]) + tuple(
+                    indices(fluor, (em_start, em_end, np.array([normWL])), k))
+            return _QYStacks(WL_F, specs[0], None, len_F, WL_S, specs[1], None, len_S,
+                             indices(fluor, (scat_start, scat_end, em_start, em_end), k),
+                             indices(solvent, (scat_start, scat_end), k),
+                             avglen, Em_BL, reabs)
+
+        QY0 = self.CalculateQY_2MM(fluor, solvent, scat_start[0], scat_end[0],
+                                   em_start[0], em_end[0], use_solvent_BL=use_solvent_BL,
+                                   dilute=dilute if usereabs else None,
+                                   normWL=normWL if usereabs else None, avglen=avglen)
+        QY = np.empty(replicas)
+        w = np.empty(replicas)
+        for start in range(0, replicas, chunksize):
+            k = min(chunksize, replicas-start)
+            QY[start:start+k], _, w[start:start+k], _ = run(k)
+        result = {'QY':QY0[0], 'UQY':QY0[1], 'mean':np.mean(QY),
+                  'std':np.std(QY, ddof=1),
+                  'percentiles':dict(zip(percentiles, np.percentile(QY, percentiles))),
+                  'w_mean':np.mean(w), 'w_std':np.std(w, ddof=1),
+                  'replicas':replicas}
+        if return_samples:
+            result['samples'] = QY
+        return result
+
+    def CalculateQY_2MM_Sweep(self, fluor, solvent, scat_start, scat_end,
+                              em_start, em_end, avglen=4, use_solvent_BL=False,
+                              dilute=None, normWL=None):
+        '''
+        Calculate QY using 2 measurement method over a grid of integration
+        windows, to check how sensitive the result is to the choice.
+
+        The arguments are as for CalculateQY_2MM, except that scat_start,
+        scat_end, em_start, em_end and avglen may each be a list of values.
+        Cumulative sums of the spectra are computed once, so that each
+        combination of windows costs the same small number of operations
+        regardless of the window lengths.
+
+        Returns QY and UQY arrays with shape
+        (len(scat_start), len(scat_end), len(em_start), len(em_end), len(avglen)).
+        '''
+        values = [np.atleast_1d(np.asarray(x, dtype=float))
+                  for x in (scat_start, scat_end, em_start, em_end)]
+        avglen = np.atleast_1d(np.asarray(avglen, dtype=int))
+        def axis(x, n):
+            shape = [1]*5
+            shape[n] = len(x)
+            return np.reshape(x, shape)
+        ScatStart_F, ScatEnd_F, EmStart_F, EmEnd_F = [
+            axis(_WLIndex(fluor.WL, x), n) for n, x in enumerate(values)]
+        ScatStart_S, ScatEnd_S = [
+            axis(_WLIndex(solvent.WL, x), n) for n, x in enumerate(values[:2])]
+        L = axis(avglen, 4)
+        #Centre the wavelengths to keep the sums of squares well conditioned.
+        W0 = np.mean(fluor.WL)
+        F = _PrefixSums(fluor.WL, fluor.SpecCorrected, fluor.USpecCorrected, W0)
+        S = _PrefixSums(solvent.WL, solvent.SpecCorrected, solvent.USpecCorrected, W0)
+        gF, cF = F.Line(ScatStart_F, ScatEnd_F, L)
+        N_Tot_sample = F.LineSubtractedSum(ScatStart_F, ScatEnd_F, gF, cF)
+        UN_Tot_sample = np.sqrt(F.Sum(F.u2, ScatStart_F, ScatEnd_F))
+        gS, cS = S.Line(ScatStart_S, ScatEnd_S, L)
+        N_Tot_empty = S.LineSubtractedSum(ScatStart_S, ScatEnd_S, gS, cS)
+        UN_Tot_empty = np.sqrt(S.Sum(S.u2, ScatStart_S, ScatEnd_S))
+        if use_solvent_BL:
+            diff = np.subtract(fluor.SpecCorrected, self.Regridder.Regrid(
+                solvent.WL, fluor.WL, solvent.SpecCorrected)[0])
+            FS = _PrefixSums(fluor.WL, diff, fluor.USpecCorrected, W0)
+            N_emitted = FS.Sum(FS.x, EmStart_F, EmEnd_F)
+        else:
+            gE, cE = F.Line(EmStart_F, EmEnd_F, L)
+            N_emitted = F.LineSubtractedSum(EmStart_F, EmEnd_F, gE, cE)
+        UN_emitted = np.sqrt(F.Sum(F.u2, EmStart_F, EmEnd_F))
+
+        w = 0
+        Uw = 0
+        if dilute is not None and normWL is not None and dilute.SpecCorrected is not None:
+            normidx = _WLIndex(fluor.WL, normWL)
+            if use_solvent_BL:
+                norm = FS.spec[normidx]
+                integ_Sphere = N_emitted/norm
+                Uinteg_sphere = np.sqrt(FS.Sum(FS.x2, EmStart_F, EmEnd_F))/abs(norm)
+            else:
+                norm = F.spec[normidx] - (gE*F.WL[normidx] + cE)
+                integ_Sphere = N_emitted/norm
+                Uinteg_sphere = np.sqrt(F.LineSubtractedSumSq(EmStart_F, EmEnd_F, gE, cE))/np.abs(norm)
+            #On the fluor grid, so the fluor indices apply.
+            D = _PrefixSums(fluor.WL, *self.Regridder.Regrid(
+                dilute.WL, fluor.WL, dilute.SpecCorrected, dilute.USpecCorrected), W0=W0)
+            Dnorm = D.spec[normidx]
+            integ_Dilute = D.Sum(D.x, EmStart_F, EmEnd_F)/Dnorm
+            Uinteg_Dilute = np.sqrt(D.Sum(D.x2, EmStart_F, EmEnd_F))/abs(Dnorm)
+            w = 1 - (integ_Sphere/integ_Dilute)
+            Uw = np.sqrt((1/(integ_Dilute**2))*(Uinteg_sphere**2) +
+                         ((integ_Sphere/(integ_Dilute**2))**2)*(Uinteg_Dilute**2))
+
+        shape = tuple(len(x) for x in values) + (len(avglen),)
+        QY, UQY = _QYFromSums(N_emitted, UN_emitted, N_Tot_empty, UN_Tot_empty,
+                              N_Tot_sample, UN_Tot_sample, w, Uw)
+        return np.broadcast_to(QY, shape).copy(), np.broadcast_to(UQY, shape).copy()
+
     def CalcStraightLine(self, WL, spec, startidx, endidx, avglen=4):
         gradient = (np.mean(spec[(endidx):(endidx+avglen)]) - np.mean(spec[(startidx-avglen):(startidx)]))/(WL[endidx+int(avglen/2)] - WL[startidx-int(avglen/2)])
         #print('spec[(endidx):(endidx+6)] = {0}, spec[(startidx):(startidx-6)] = {1}, WL[endidx+3] = {2}, WL[startidx-3] = {3}'.format(
@@ -245,6 +687,7 @@ class FluorSpecReader():
         #print('gradient = {0}, constant = {1}'.format(gradient, const))
         return np.add(np.multiply(WL,gradient),const)
 
+    @Timed('reabs')
     def CalcReabsProb(self, sphere, em_start, em_end, normWL,
                       Em_BL_Fluor, dilute, verbose=False):
         '''
@@ -254,44 +697,430 @@ class FluorSpecReader():
         - Corrected fluorescence spec in sphere.
         - PTI_Data object for above.
         - Emission integration range start, then end.
-        - A wavelength to normalise both spectra to (needs to be somwhere that
-          still has counts but minimal reabsorption).
+        - The index (in the sphere WL grid) of a wavelength to normalise both
+          spectra to (needs to be somwhere that still has counts but minimal
+          reabsorption).
         - Corrected fluorescence spec for a dilute (not reabsorbed) sample.
         - PTI_Data object for above.
         - Option to print results to console.
+        The dilute spectrum is resampled onto the sphere WL grid if they differ.
         '''
-        StartIdx_Sphere = sphere.WL.index(np.interp(em_start, sphere.WL, sphere.WL))
-        EndIdx_Sphere = sphere.WL.index(np.interp(em_end, sphere.WL, sphere.WL))
-        StartIdx_Dilute = dilute.WL.index(np.interp(em_start, dilute.WL, dilute.WL))
-        EndIdx_Dilute = dilute.WL.index(np.interp(em_end, dilute.WL, dilute.WL))
+        StartIdx_Sphere = _WLIndex(sphere.WL, em_start)
+        EndIdx_Sphere = _WLIndex(sphere.WL, em_end)
+        StartIdx_Dilute = StartIdx_Sphere
+        EndIdx_Dilute = EndIdx_Sphere
+        DiluteSpec, UDiluteSpec = self.Regridder.Regrid(dilute.WL, sphere.WL,
+                                                        dilute.SpecCorrected,
+                                                        dilute.USpecCorrected)
         spherespec = np.subtract(sphere.SpecCorrected, Em_BL_Fluor)
-        integ_Sphere = sum(np.divide(spherespec[StartIdx_Sphere:EndIdx_Sphere],
+        integ_Sphere = np.sum(np.divide(spherespec[StartIdx_Sphere:EndIdx_Sphere],
                                      spherespec[normWL]))
-        Uinteg_sphere = np.sqrt(sum(np.power(np.divide(spherespec[StartIdx_Sphere:EndIdx_Sphere],
+        Uinteg_sphere = np.sqrt(np.sum(np.power(np.divide(spherespec[StartIdx_Sphere:EndIdx_Sphere],
                                                        spherespec[normWL]),2)))
-        integ_Dilute = sum(np.divide(dilute.SpecCorrected[StartIdx_Dilute:EndIdx_Dilute],
-                                     dilute.SpecCorrected[normWL]))
-        Uinteg_Dilute = np.sqrt(sum(np.power(np.divide(dilute.SpecCorrected[StartIdx_Sphere:EndIdx_Sphere],
-                                                       dilute.SpecCorrected[normWL]),2)))
+        integ_Dilute = np.sum(np.divide(DiluteSpec[StartIdx_Dilute:EndIdx_Dilute],
+                                     DiluteSpec[normWL]))
+        Uinteg_Dilute = np.sqrt(np.sum(np.power(np.divide(DiluteSpec[StartIdx_Dilute:EndIdx_Dilute],
+                                                       DiluteSpec[normWL]),2)))
         w = 1 - (integ_Sphere/integ_Dilute)
         Uw = np.sqrt((1/(integ_Dilute**2))*(Uinteg_sphere**2) +
                     ((integ_Sphere/(integ_Dilute**2))**2)*(Uinteg_Dilute**2))
         if verbose:
             print("Reabsorption calculation:\n Sphere integral = {0}, Dilute integral = {1}, 1-w = {2}, w = {3} +/- {4}".format(
                     integ_Sphere, integ_Dilute, 1-w, w, Uw))
-            plt.figure()
-            plt.errorbar(sphere.WL[StartIdx_Sphere:EndIdx_Sphere], np.divide(
+        if self._WantPlots(verbose):
+            fig = FluorSpec.Diagnostics.DiagnosticFigure(
+                'reabs_' + _BaseName(sphere), title=_PlotTitle(sphere),
+                xlabel='Wavelength (nm)', ylabel='Fluorescence Intensity (AU)',
+                legend={'fontsize':12})
+            fig.Add('errorbar', sphere.WL[StartIdx_Sphere:EndIdx_Sphere], np.divide(
                 spherespec[StartIdx_Sphere:EndIdx_Sphere],spherespec[normWL]),
                 yerr=np.divide(sphere.USpecCorrected[StartIdx_Sphere:EndIdx_Sphere],spherespec[normWL]),
                 color='g', label='QY spectrum (with reabsorption)')
-            plt.errorbar(dilute.WL[StartIdx_Dilute:EndIdx_Dilute], np.divide(
-                dilute.SpecCorrected[StartIdx_Dilute:EndIdx_Dilute], dilute.SpecCorrected[normWL]),
-                yerr=np.divide(dilute.USpecCorrected[StartIdx_Dilute:EndIdx_Dilute],dilute.SpecCorrected[normWL]),
+            fig.Add('errorbar', sphere.WL[StartIdx_Dilute:EndIdx_Dilute], np.divide(
+                DiluteSpec[StartIdx_Dilute:EndIdx_Dilute], DiluteSpec[normWL]),
+                yerr=np.divide(UDiluteSpec[StartIdx_Dilute:EndIdx_Dilute],DiluteSpec[normWL]),
                 color='r', label='Dilute spectrum (no reabsorption)')
-            plt.legend(fontsize=12)
-            plt.title('file: ' + str(sphere.FilePath.split('\\')[-1]) +
-                '\n Excitation' + str(sphere.ExRange) +
-                ' nm, Emission ' + str(sphere.EmRange) + ' nm')
-            plt.xlabel('Wavelength (nm)')
-            plt.ylabel('Fluorescence Intensity (AU)')
-        return w, Uw
\ No newline at end of file
+            self._Plot(fig)
+        return w, Uw
+
+
+class CorrectionPlan():
+    '''
+    A spectral correction precomputed for one WL grid.
+
+    Everything that doesn't depend on the raw spectrum (the background and
+    its variance, the file correction and the synchronous scan correction
+    and its uncertainty) is worked out once, so that Apply only has to do a
+    few in-place array operations. The operations are done in the same
+    order as in FluorSpecReader.ApplyCorrFileToRaw, so the results are
+    identical. Usually made by FluorSpecReader.MakeCorrectionPlan.
+    '''
+    def __init__(self, WL, CorrVals=None, bckgnd=0, extracorr=None, factor=None):
+        '''
+        Arguments:
+        - the WL grid of the spectra to correct.
+        - the correction file values on that grid (None for no correction).
+        - the background (list or scalar) to subtract from the raw data.
+        - an optional synchronous scan PTI_Data object to divide by.
+        - an optional multiplicative factor for the raw data and background.
+        '''
+        self.WL = np.asarray(WL, dtype=float)
+        self.factor = factor
+        if factor is not None:
+            bckgnd = np.multiply(bckgnd, factor)
+        self.bckgnd = np.asarray(bckgnd, dtype=float)
+        #Variance of the background, computed as in ApplyCorrFileToRaw.
+        self.Vbckgnd = np.power(np.sqrt(self.bckgnd), 2)
+        self.CorrVals = None if CorrVals is None else np.asarray(CorrVals, dtype=float)
+        self.extracorr_vals = None
+        if extracorr is not None:
+            self.extracorr_vals = np.interp(self.WL, extracorr.WL, extracorr.Spec)
+            Raw_extracorr = np.interp(self.WL, extracorr.WL, extracorr.SpecRaw)
+            URaw_extracorr = np.sqrt(Raw_extracorr)
+            self.Uextracorr = np.multiply(self.extracorr_vals,
+                                          np.divide(URaw_extracorr, Raw_extracorr))
+            self.Invextracorr = np.divide(1, self.extracorr_vals)
+
+    def Apply(self, rawspec, uspec):
+        '''
+        Return the corrected spectrum and its uncertainty.
+
+        rawspec and uspec may also be 2-D arrays with one spectrum per row.
+        '''
+        if self.factor is not None:
+            CorrData = np.multiply(rawspec, self.factor)
+        else:
+            CorrData = np.array(rawspec, dtype=float)
+        np.subtract(CorrData, self.bckgnd, out=CorrData)
+        UCorrData = np.square(np.asarray(uspec, dtype=float))
+        np.add(UCorrData, self.Vbckgnd, out=UCorrData)
+        np.sqrt(UCorrData, out=UCorrData)
+        if self.CorrVals is not None:
+            np.multiply(CorrData, self.CorrVals, out=CorrData)
+            np.multiply(UCorrData, self.CorrVals, out=UCorrData)
+        if self.extracorr_vals is not None:
+            np.multiply(self.Invextracorr, UCorrData, out=UCorrData)
+            np.square(UCorrData, out=UCorrData)
+            np.divide(CorrData, self.extracorr_vals, out=CorrData)
+            tmp = np.divide(CorrData, self.extracorr_vals)
+            np.multiply(tmp, self.Uextracorr, out=tmp)
+            np.square(tmp, out=tmp)
+            np.add(UCorrData, tmp, out=UCorrData)
+            np.sqrt(UCorrData, out=UCorrData)
+        return CorrData, UCorrData
+
+    def ApplyToData(self, data):
+        '''
+        Correct the raw spectrum of a PTI_Data object and register the result.
+        '''
+        rawspec, uspec = _RawSpec(data)
+        if rawspec is None:
+            _log.error("Analyse.CorrectionPlan ERROR!! Bad file")
+            return
+        CorrData, UCorrData = self.Apply(rawspec, uspec)
+        data.RegisterCorrSpec(CorrData, UCorrData)
+        return CorrData, UCorrData
+
+
+def _BaseName(data):
+    return str(getattr(data, 'FilePath', '')).replace('\\', '/').split('/')[-1]
+
+
+def _PlotTitle(data):
+    return ('file: ' + str(data.FilePath.split('\\')[-1]) +
+            '\n Excitation' + str(data.ExRange) +
+            ' nm, Emission ' + str(data.EmRange) + ' nm')
+
+
+def _RawSpec(data):
+    '''
+    Return the raw spectrum and its uncertainty from a PTI_Data object
+    (the trace for Trace and Group files), or (None, None) for a bad file.
+    '''
+    if getattr(data, 'FileType', None) is None:
+        return None, None
+    elif data.FileType.value > 2:
+        return data.Trace, data.UTrace
+    elif data.FileType.value == 2:
+        return data.SpecRaw, data.USpecRaw
+    return None, None
+
+
+def _FindFiles(path, pattern='*', recursive=False):
+    '''
+    Sorted list of the files under path whose names match pattern.
+    '''
+    if not recursive:
+        return sorted(os.path.join(path, f) for f in fnmatch.filter(os.listdir(path), pattern)
+                      if os.path.isfile(os.path.join(path, f)))
+    paths = []
+    for root, dirs, files in os.walk(path):
+        paths += [os.path.join(root, f) for f in fnmatch.filter(files, pattern)]
+    return sorted(paths)
+
+
+def _ReadFiles(fnames, lazy=False, quiet=True, compact=None):
+    '''
+    Read a chunk of files (in a worker) and return a list of
+    (fname, PTI_Data or None, messages). If compact is a dtype the objects
+    are CompactPTI_Data.
+    '''
+    results = []
+    for fname in fnames:
+        try:
+            data = FluorSpec.PTI_Data.PTI_Data(fname, lazy=lazy, quiet=quiet)
+        except Exception as e:
+            results.append((fname, None, ['ERROR!! {0}: {1}'.format(type(e).__name__, e)]))
+            continue
+        if data.SuccessfullyRead:
+            if compact is not None:
+                data = data.Compact(compact)
+            results.append((fname, data, data.Messages))
+        else:
+            results.append((fname, None, data.Messages))
+    return results
+
+
+def _StackCorrected(datalist):
+    '''
+    Stack the WL grids and corrected spectra of PTI_Data objects into N x M
+    arrays (padded with NaN to the longest grid). Also returns the lengths.
+    '''
+    lengths = np.array([len(d.WL) for d in datalist], dtype=int)
+    M = lengths.max() if len(lengths) else 0
+    WL, spec, uspec = [np.full((len(datalist), M), np.nan) for i in range(3)]
+    for i, d in enumerate(datalist):
+        WL[i, :lengths[i]] = d.WL
+        spec[i, :lengths[i]] = d.SpecCorrected
+        uspec[i, :lengths[i]] = d.USpecCorrected
+    return WL, spec, uspec, lengths
+
+
+class _PrefixSums():
+    '''
+    Cumulative sums of a spectrum, for O(1) sums over any window [a, b).
+    Wavelengths are taken relative to W0.
+    '''
+    def __init__(self, WL, spec, uspec, W0=0):
+        self.WL = np.asarray(WL, dtype=float) - W0
+        self.spec = np.asarray(spec, dtype=float)
+        self.M = len(self.spec)
+        def cumsum(x):
+            return np.concatenate(([0.], np.cumsum(x)))
+        self.x = cumsum(self.spec)
+        self.x2 = cumsum(self.spec**2)
+        self.xw = cumsum(self.spec*self.WL)
+        self.w = cumsum(self.WL)
+        self.w2 = cumsum(self.WL**2)
+        self.u2 = cumsum(np.square(uspec))
+
+    def Sum(self, cs, a, b):
+        '''
+        Sum over [a, b) of the quantity with cumulative sum cs. An inverted
+        window (b < a) is empty, as the slice data[a:b] would be.
+        '''
+        a, b = self._Clip(a, b)
+        return cs[b] - cs[a]
+
+    def Count(self, a, b):
+        a, b = self._Clip(a, b)
+        return b - a
+
+    def _Clip(self, a, b):
+        a = np.clip(a, 0, self.M)
+        return a, np.clip(b, a, self.M)
+
+    def Line(self, startidx, endidx, avglen):
+        '''
+        Gradient and constant (relative to W0) of the straight line baseline
+        of FluorSpecReader.CalcStraightLine.
+        '''
+        half = avglen//2
+        endmean = self.Sum(self.x, endidx, endidx+avglen)/self.Count(endidx, endidx+avglen)
+        startmean = self.Sum(self.x, startidx-avglen, startidx)/self.Count(startidx-avglen, startidx)
+        WLend = self.WL[np.clip(endidx+half, 0, self.M-1)]
+        WLstart = self.WL[np.clip(startidx-half, 0, self.M-1)]
+        gradient = (endmean - startmean)/(WLend - WLstart)
+        const = endmean - gradient*self.WL[endidx]
+        return gradient, const
+
+    def LineSubtractedSum(self, a, b, gradient, const):
+        '''
+        Sum over [a, b) of spec - (gradient*WL + const).
+        '''
+        return (self.Sum(self.x, a, b) - gradient*self.Sum(self.w, a, b)
+                - const*self.Count(a, b))
+
+    def LineSubtractedSumSq(self, a, b, gradient, const):
+        '''
+        Sum over [a, b) of (spec - (gradient*WL + const))**2.
+        '''
+        return (self.Sum(self.x2, a, b) - 2*gradient*self.Sum(self.xw, a, b)
+                - 2*const*self.Sum(self.x, a, b)
+                + gradient**2*self.Sum(self.w2, a, b)
+                + 2*gradient*const*self.Sum(self.w, a, b)
+                + const**2*self.Count(a, b))
+
+
+def _InterpRows(x, xp, fp):
+    '''
+    np.interp(x, xp, row) for every row of the 2-D array fp.
+    '''
+    xp = np.asarray(xp, dtype=float)
+    idx = np.clip(np.searchsorted(xp, x), 1, len(xp)-1)
+    frac = np.clip((np.asarray(x) - xp[idx-1])/(xp[idx] - xp[idx-1]), 0, 1)
+    return fp[:, idx-1]*(1-frac) + fp[:, idx]*frac
+
+
+def _WLIndexRows(WL, lengths, values):
+    '''
+    _WLIndex for each row of a stack of (NaN padded) wavelength grids.
+    '''
+    rows = np.arange(len(lengths))
+    #For ascending rows, the number of points below the value is searchsorted.
+    idx = np.clip(np.sum(WL < values[:, None], axis=1), 1, lengths-1)
+    idx -= (values - WL[rows, idx-1]) <= (WL[rows, idx] - values)
+    return idx
+
+
+def _WindowMeans(spec, start, length):
+    '''
+    Mean of spec[i, start[i]:start[i]+length] for each row (NaN padding and
+    points off the ends of the rows are left out).
+    '''
+    idx = start[:, None] + np.arange(length)
+    valid = (idx >= 0) & (idx < spec.shape[1])
+    vals = np.take_along_axis(spec, np.clip(idx, 0, spec.shape[1]-1), axis=1)
+    valid &= ~np.isnan(vals)
+    return np.sum(np.where(valid, vals, 0), axis=1)/np.sum(valid, axis=1)
+
+
+def _StraightLines(WL, spec, lengths, startidx, endidx, avglen=4):
+    '''
+    FluorSpecReader.CalcStraightLine for each row of a stack of spectra.
+    '''
+    half = int(avglen/2)
+    endmean = _WindowMeans(spec, endidx, avglen)
+    startmean = _WindowMeans(spec, startidx-avglen, avglen)
+    WLend = np.take_along_axis(WL, np.clip(endidx+half, 0, lengths-1)[:, None], axis=1)[:, 0]
+    WLstart = np.take_along_axis(WL, np.clip(startidx-half, 0, lengths-1)[:, None], axis=1)[:, 0]
+    gradient = (endmean - startmean)/(WLend - WLstart)
+    const = endmean - gradient*WL[np.arange(len(WL)), endidx]
+    return WL*gradient[:, None] + const[:, None]
+
+
+def _WindowSums(x, start, end):
+    '''
+    Sum of x[i, start[i]:end[i]] for each row.
+    '''
+    if len(start) == 0:
+        return np.zeros(0)
+    #Only the columns covered by some window are needed.
+    lo = max(int(np.min(start)), 0)
+    hi = max(int(np.max(end)), lo)
+    cols = np.arange(lo, hi)
+    mask = (cols >= start[:, None]) & (cols < end[:, None])
+    return np.sum(np.where(mask, x[:, lo:hi], 0), axis=1)
+
+
+def _QYStacks(WL_F, F, UF, len_F, WL_S, S, US, len_S, FluorIdx, SolventIdx,
+              avglen=4, Em_BL=None, reabs=None):
+    '''
+    The CalculateQY_2MM calculation for each row of stacks of fluor and
+    solvent spectra (from _StackCorrected).
+
+    FluorIdx holds the scatter start/end and emission start/end indices of
+    each fluor row and SolventIdx the scatter start/end indices of each
+    solvent row. UF and US may be None if the uncertainties aren't needed.
+    Em_BL is None to fit straight emission baselines, or a stack of
+    baselines (e.g. solvent spectra) on the fluor grids.
+    reabs is None or (rows, dilute stack, dilute emission start/end indices,
+    normalisation indices) for the rows with a reabsorption correction, with
+    the dilute spectra on the fluor grids of those rows.
+    Returns QY, UQY, w and Uw arrays.
+    '''
+    ScatStartIdx_Fluor, ScatEndIdx_Fluor, EmStartIdx_Fluor, EmEndIdx_Fluor = FluorIdx
+    ScatStartIdx_Solvent, ScatEndIdx_Solvent = SolventIdx
+    #Calculate baselines
+    Scat_BL_Fluor = _StraightLines(WL_F, F, len_F, ScatStartIdx_Fluor,
+                                   ScatEndIdx_Fluor, avglen)
+    Scat_BL_Solvent = _StraightLines(WL_S, S, len_S, ScatStartIdx_Solvent,
+                                     ScatEndIdx_Solvent, avglen)
+    if Em_BL is not None:
+        Em_BL_Fluor = Em_BL
+    else:
+        Em_BL_Fluor = _StraightLines(WL_F, F, len_F, EmStartIdx_Fluor,
+                                     EmEndIdx_Fluor, avglen)
+    FluorSig = F - Em_BL_Fluor
+    N_emitted = _WindowSums(FluorSig, EmStartIdx_Fluor, EmEndIdx_Fluor)
+    N_Tot_empty = _WindowSums(S - Scat_BL_Solvent, ScatStartIdx_Solvent,
+                              ScatEndIdx_Solvent)
+    N_Tot_sample = _WindowSums(F - Scat_BL_Fluor, ScatStartIdx_Fluor,
+                               ScatEndIdx_Fluor)
+    if UF is None or US is None:
+        UN_emitted = UN_Tot_empty = UN_Tot_sample = 0
+    else:
+        UN_emitted = np.sqrt(_WindowSums(UF**2, EmStartIdx_Fluor, EmEndIdx_Fluor))
+        UN_Tot_empty = np.sqrt(_WindowSums(US**2, ScatStartIdx_Solvent,
+                                           ScatEndIdx_Solvent))
+        UN_Tot_sample = np.sqrt(_WindowSums(UF**2, ScatStartIdx_Fluor,
+                                            ScatEndIdx_Fluor))
+    w = np.zeros(len(F))
+    Uw = np.zeros(len(F))
+    if reabs is not None:
+        rows, D, StartIdx_Dilute, EndIdx_Dilute, normidx = reabs
+        w[rows], Uw[rows] = _ReabsProbs(FluorSig[rows], EmStartIdx_Fluor[rows],
+                                        EmEndIdx_Fluor[rows], D, StartIdx_Dilute,
+                                        EndIdx_Dilute, normidx)
+    QY, UQY = _QYFromSums(N_emitted, UN_emitted, N_Tot_empty, UN_Tot_empty,
+                          N_Tot_sample, UN_Tot_sample, w, Uw)
+    return QY, UQY, w, Uw
+
+
+def _ReabsProbs(spherespec, StartIdx_Sphere, EndIdx_Sphere, dilutespec,
+                StartIdx_Dilute, EndIdx_Dilute, normidx):
+    '''
+    FluorSpecReader.CalcReabsProb for each row of a stack of baseline
+    subtracted sphere spectra and dilute spectra. Returns w and Uw.
+    '''
+    rows = np.arange(len(spherespec))
+    sphere = spherespec/spherespec[rows, normidx][:, None]
+    dilute = dilutespec/dilutespec[rows, normidx][:, None]
+    integ_Sphere = _WindowSums(sphere, StartIdx_Sphere, EndIdx_Sphere)
+    Uinteg_sphere = np.sqrt(_WindowSums(sphere**2, StartIdx_Sphere, EndIdx_Sphere))
+    integ_Dilute = _WindowSums(dilute, StartIdx_Dilute, EndIdx_Dilute)
+    Uinteg_Dilute = np.sqrt(_WindowSums(dilute**2, StartIdx_Dilute, EndIdx_Dilute))
+    w = 1 - (integ_Sphere/integ_Dilute)
+    Uw = np.sqrt((1/(integ_Dilute**2))*(Uinteg_sphere**2) +
+                 ((integ_Sphere/(integ_Dilute**2))**2)*(Uinteg_Dilute**2))
+    return w, Uw
+
+
+def _QYFromSums(N_emitted, UN_emitted, N_Tot_empty, UN_Tot_empty,
+                N_Tot_sample, UN_Tot_sample, w, Uw):
+    '''
+    QY and UQY from the integrals, with the reabsorption correction (as in
+    FluorSpecReader.CalculateQY_2MM). Works on scalars or arrays.
+    '''
+    QY = N_emitted/(N_Tot_empty - N_Tot_sample)
+    UQY = np.sqrt((1/(N_Tot_empty-N_Tot_sample)**2)*(UN_emitted**2) +
+                  ((QY/(N_Tot_empty-N_Tot_sample))**2)*(UN_Tot_empty**2 + UN_Tot_sample**2))
+    QY_w = QY/(1- w + w*QY)
+    UQY = np.sqrt(((QY_w/QY)**2)*(UQY**2) +
+                  (((1-QY)*QY_w/(1-w+w*QY))**2)*(Uw**2))
+    return QY_w, UQY
+
+
+def _WLIndex(WL, value):
+    '''
+    Index of the point of the (ascending) wavelength grid WL nearest to value.
+
+    value may be a scalar or an array; values outside the grid give the
+    first or last index.
+    '''
+    WL = np.asarray(WL)
+    idx = np.clip(np.searchsorted(WL, value), 1, len(WL)-1)
+    idx = idx - ((value - WL[idx-1]) <= (WL[idx] - value))
+    if np.ndim(idx) == 0:
+        return int(idx)
+    return idx.astype(int)
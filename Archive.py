@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+'''
+An SQLite index of the header information of an archive of PTI exports,
+so that files can be found without parsing every one of them.
+'''
+import os
+import time
+import json
+import sqlite3
+import FluorSpec.PTI_Data
+import FluorSpec.Analyse
+
+class PTI_Archive():
+    '''
+    Index the PTI exports under a directory tree in an SQLite database.
+
+    Only the header of each file is read (see PTI_Data's lazy mode).
+    Re-indexing only reads the files that are new or whose size or mtime
+    changed, and forgets files that have gone.
+    '''
+    Schema = '''CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    filetype TEXT,
+                    runtype TEXT,
+                    pmtmode TEXT,
+                    acqstart REAL,
+                    numsamples INTEGER,
+                    exrange TEXT,
+                    emrange TEXT,
+                    ex_min REAL,
+                    ex_max REAL,
+                    em_min REAL,
+                    em_max REAL,
+                    success INTEGER,
+                    messages TEXT)'''
+    Indices = ('CREATE INDEX IF NOT EXISTS files_type ON files (filetype, runtype)',
+               'CREATE INDEX IF NOT EXISTS files_acqstart ON files (acqstart)')
+
+    def __init__(self, dbpath):
+        '''
+        Open (or create) the index database at dbpath (':memory:' is allowed).
+        '''
+        self.DBPath = dbpath
+        self.Connection = sqlite3.connect(dbpath)
+        self.Connection.execute(self.Schema)
+        for stmt in self.Indices:
+            self.Connection.execute(stmt)
+        self.Connection.commit()
+
+    def Close(self):
+        self.Connection.close()
+
+    def Index(self, root, pattern='*.txt', recursive=True):
+        '''
+        Add or update the files under root that match pattern.
+
+        Returns the numbers of files (added or changed, unchanged, removed).
+        '''
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, '')
+        #LIKE narrows the search; % and _ in root are wildcards, so check again.
+        #Only the files the walk could see are candidates for removal.
+        known = dict(((row[0], (row[1], row[2])) for row in self.Connection.execute(
+            'SELECT path, size, mtime FROM files WHERE path LIKE ?', (prefix + '%',))
+                      if row[0].startswith(prefix) and
+                      (recursive or os.path.dirname(row[0]) == root)))
+        seen = set()
+        rows = []
+        unchanged = 0
+        for path in FluorSpec.Analyse._FindFiles(root, pattern, recursive):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            seen.add(path)
+            if known.get(path) == (st.st_size, st.st_mtime):
+                unchanged += 1
+                continue
+            rows.append(self._HeaderRow(path, st))
+        gone = [(path,) for path in known if path not in seen]
+        with self.Connection:
+            self.Connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES ({0})'.format(','.join('?'*16)), rows)
+            self.Connection.executemany('DELETE FROM files WHERE path = ?', gone)
+        return len(rows), unchanged, len(gone)
+
+    def Query(self, filetype=None, runtype=None, pmtmode=None, ex=None, em=None,
+              start=None, end=None, tolerance=0.5, where=None, params=(),
+              load=False, onlygood=True):
+        '''
+        Return the paths (or, if load is True, lazily loaded PTI_Data objects)
+        of the indexed files that match all of the given conditions:
+        - filetype, runtype and pmtmode names (e.g. 'Session', 'Emission',
+          'Digital').
+        - an excitation and/or emission wavelength (nm) within the file's
+          range, give or take tolerance.
+        - an acquisition start time after start and/or before end, as a
+          time.struct_time, seconds since the epoch, or 'YYYY-MM-DD[ HH:MM:SS]'.
+        - an extra SQL condition on the files table, with its parameters.
+        Files whose header couldn't be read are left out if onlygood is True.
+        Results are in order of acquisition time.
+        '''
+        conds = []
+        args = []
+        for column, val in (('filetype', filetype), ('runtype', runtype),
+                            ('pmtmode', pmtmode)):
+            if val is not None:
+                conds.append('{0} = ?'.format(column))
+                args.append(val)
+        for name, val in (('ex', ex), ('em', em)):
+            if val is not None:
+                conds.append('{0}_min <= ? AND {0}_max >= ?'.format(name))
+                args += [val + tolerance, val - tolerance]
+        if start is not None:
+            conds.append('acqstart >= ?')
+            args.append(_EpochTime(start))
+        if end is not None:
+            conds.append('acqstart <= ?')
+            args.append(_EpochTime(end))
+        if onlygood:
+            conds.append('success = 1')
+        if where is not None:
+            conds.append('({0})'.format(where))
+            args += list(params)
+        sql = 'SELECT path FROM files'
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY acqstart, path'
+        paths = [row[0] for row in self.Connection.execute(sql, args)]
+        if load:
+            return [FluorSpec.PTI_Data.PTI_Data(path, lazy=True, quiet=True)
+                    for path in paths]
+        return paths
+
+    def _HeaderRow(self, path, st):
+        try:
+            data = FluorSpec.PTI_Data.PTI_Data(path, lazy=True, quiet=True)
+        except Exception as e:
+            return (path, st.st_size, st.st_mtime) + (None,)*11 + (
+                0, json.dumps(['ERROR!! {0}: {1}'.format(type(e).__name__, e)]))
+        filetype = getattr(data, 'FileType', None)
+        runtype = getattr(data, 'RunType', None)
+        acqstart = getattr(data, 'AcqStart', None)
+        exrange = getattr(data, 'ExRange', None)
+        emrange = getattr(data, 'EmRange', None)
+        return (path, st.st_size, st.st_mtime,
+                None if filetype is None else filetype.name,
+                None if runtype is None else runtype.name,
+                getattr(data, 'PMTmode', None),
+                None if acqstart is None else time.mktime(acqstart),
+                getattr(data, 'NumSamples', None),
+                json.dumps(exrange), json.dumps(emrange),
+                min(exrange) if exrange else None, max(exrange) if exrange else None,
+                min(emrange) if emrange else None, max(emrange) if emrange else None,
+                int(bool(data.SuccessfullyRead)), json.dumps(data.Messages))
+
+
+def _EpochTime(t):
+    '''
+    Seconds since the epoch for a struct_time, a number or a date string.
+    '''
+    if isinstance(t, time.struct_time):
+        return time.mktime(t)
+    if isinstance(t, str):
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                return time.mktime(time.strptime(t, fmt))
+            except ValueError:
+                pass
+        raise ValueError('Bad time string {0}'.format(t))
+    return float(t)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python2
+'''
+Benchmarks of the parser and the analysis, run on synthetic PTI exports.
+
+Run as a script (python -m FluorSpec.Benchmark --help) or call
+RunBenchmarks. The results are a dict (and optionally a JSON file) with the
+time, throughput and peak memory of each stage, so that runs can be
+compared with CompareBenchmarks.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import FluorSpec.PTI_Data
+import FluorSpec.Analyse
+
+class SyntheticExports():
+    '''
+    Write synthetic Session, Trace and Group (correction) files in the
+    layouts PTI_Data reads.
+
+    The spectra are a Gaussian scatter peak at the excitation wavelength,
+    a broad emission band and a sloping baseline, with Poisson noise.
+    '''
+    def __init__(self, outdir, npoints=501, wlrange=(250., 750.), ex=300.,
+                 seed=0):
+        '''
+        Arguments:
+        - the directory to write the files to (made if it doesn't exist).
+        - the number of points and the emission range of the Session spectra.
+        - the excitation wavelength.
+        - a seed for the random numbers.
+        '''
+        self.OutDir = outdir
+        self.NumPoints = npoints
+        self.WLRange = wlrange
+        self.Ex = ex
+        self.rng = np.random.default_rng(seed)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+    def Grid(self):
+        return np.linspace(self.WLRange[0], self.WLRange[1], self.NumPoints)
+
+    def Spectrum(self, WL, scatter=1e5, emission=2e3, emcentre=None):
+        '''
+        Expected counts at WL for a sample with the given scatter peak height
+        and emission band height (centred emcentre, default Ex + 120 nm).
+        '''
+        if emcentre is None:
+            emcentre = self.Ex + 120
+        return (scatter*np.exp(-0.5*((WL - self.Ex)/3.)**2) +
+                emission*np.exp(-0.5*((WL - emcentre)/40.)**2) +
+                50 + 0.05*WL)
+
+    def Session(self, name, scatter=1e5, emission=2e3, sync=False):
+        '''
+        Write an Emission (or, if sync is True, Synchronous) Session file
+        and return its path.
+        '''
+        WL = self.Grid()
+        raw = self.rng.poisson(self.Spectrum(WL, scatter, emission)).astype(float)
+        photodiode = self.rng.uniform(0.9, 1.1, len(WL))
+        if sync:
+            ex = '{0:g}-{1:g}'.format(*self.WLRange)
+        else:
+            ex = '{0:g}'.format(self.Ex)
+        path = os.path.join(self.OutDir, name)
+        WriteSession(path, WL, raw, photodiode, ex)
+        return path
+
+    def Trace(self, name, nsamples=100000):
+        '''
+        Write a time based Trace file of nsamples points and return its path.
+        '''
+        t = np.arange(nsamples)*0.01
+        counts = self.rng.poisson(1e4*np.exp(-t/(t[-1] + 1)) + 100).astype(float)
+        path = os.path.join(self.OutDir, name)
+        WriteTrace(path, t, counts, '{0:g}:{1:g}'.format(self.Ex, self.Ex + 120))
+        return path
+
+    def CorrectionFiles(self):
+        '''
+        Write emcorri.txt, emcorr-sphere.txt, emcorr-sphere-quanta.txt and
+        excorr.txt to a correction_data directory, and return a CorrFiles
+        dict (relative to OutDir) for a FluorSpecReader.
+        '''
+        corrdir = os.path.join(self.OutDir, 'correction_data')
+        if not os.path.isdir(corrdir):
+            os.makedirs(corrdir)
+        corrfiles = {'default':None}
+        for key in ('emcorri', 'emcorr-sphere', 'emcorr-sphere-quanta', 'excorr'):
+            WL = np.arange(self.WLRange[0], self.WLRange[1] + 101, 2.)
+            values = 1 + 1.5*np.exp(-0.5*((WL - 500)/150.)**2) + \
+                     self.rng.uniform(-0.01, 0.01, len(WL))
+            WriteGroup(os.path.join(corrdir, key + '.txt'), WL, values, key)
+            corrfiles[key] = os.path.join('correction_data', key + '.txt')
+        return corrfiles
+
+    def QYSets(self, nsets):
+        '''
+        Write nsets (fluor, solvent, dilute) Session files for the QY
+        calculation and return a list of their paths.
+        '''
+        sets = []
+        for i in range(nsets):
+            sets.append((self.Session('fluor{0:05d}.txt'.format(i), scatter=6e4,
+                                      emission=self.rng.uniform(1e3, 3e3)),
+                         self.Session('solvent{0:05d}.txt'.format(i), scatter=1e5,
+                                      emission=0),
+                         self.Session('dilute{0:05d}.txt'.format(i), scatter=0,
+                                      emission=1e3)))
+        return sets
+
+
+def WriteSession(fname, WL, SpecRaw, Photodiode, ex, pmtmode='D', acqstart=None):
+    '''
+    Write a Session export: 8 header lines, the spectrum (WL, raw, excitation
+    corrected, spectrum and corrected columns), 7 lines and the photodiode
+    (excitation correction) block.
+
+    ex is the excitation part of the range line, e.g. '300' or '250-750'.
+    '''
+    N = len(WL)
+    if acqstart is None:
+        acqstart = time.localtime()
+    SpecRaw = np.asarray(SpecRaw, dtype=float)
+    Photodiode = np.asarray(Photodiode, dtype=float)
+    cols = np.column_stack((WL, SpecRaw, SpecRaw/Photodiode, SpecRaw,
+                            SpecRaw/Photodiode))
+    lines = ['<Session>',
+             'Acquired on ' + time.strftime('%Y-%m-%d %H:%M:%S', acqstart),
+             'Synthetic',
+             'Detector1',
+             '1',
+             '{0}\t'.format(N),
+             '{0} {1}:{2:g}-{3:g}'.format(pmtmode, ex, WL[0], WL[-1]),
+             'X\tRaw\tExCorr\tSpec\tCorr']
+    lines += ['\t'.join('{0:g}'.format(v) for v in row) for row in cols]
+    lines += ['', '<Trace>', 'Photodiode', '1', '{0}\t'.format(N),
+              '{0} {1}:{2:g}-{3:g}'.format(pmtmode, ex, WL[0], WL[-1]), 'X\tY']
+    lines += ['{0:g}\t{1:g}'.format(w, v) for w, v in zip(WL, Photodiode)]
+    lines += ['</Trace>', '</Session>']
+    with open(fname, 'w') as thefile:
+        thefile.write('\n'.join(lines) + '\n')
+
+
+def WriteTrace(fname, WL, Trace, wlrange, pmtmode='D'):
+    '''
+    Write a Trace export; wlrange is e.g. '300:420' or '300:350-600'.
+    '''
+    lines = ['<Trace>', '{0}'.format(len(WL)),
+             '{0} {1}'.format(pmtmode, wlrange), 'X\tY']
+    lines += ['{0:g}\t{1:g}'.format(w, v) for w, v in zip(WL, Trace)]
+    lines.append('</Trace>')
+    with open(fname, 'w') as thefile:
+        thefile.write('\n'.join(lines) + '\n')
+
+
+def WriteGroup(fname, WL, Values, key):
+    '''
+    Write a correction file in the Group layout of correction_data (the
+    file name must contain excorr or emcorr).
+    '''
+    lines = ['<Group>', 'Detector1', '1', '{0}\t'.format(len(WL)),
+             '{0}\tT{1}'.format(key, int(time.time()*1e7)), 'X\tY']
+    lines += ['{0:g}\t{1:.9g}'.format(w, v) for w, v in zip(WL, Values)]
+    lines.append('</Group>')
+    with open(fname, 'w') as thefile:
+        thefile.write('\n'.join(lines) + '\n')
+
+
+def RunBenchmarks(outdir=None, nsets=50, npoints=501, tracelength=100000,
+                  repeats=3, jsonfile=None, keep=False):
+    '''
+    Generate the synthetic files and time each stage.
+
+    Arguments:
+    - the directory for the files (default: a temporary one, deleted
+      afterwards unless keep is True).
+    - the number of (fluor, solvent, dilute) Session sets, the number of
+      points in each spectrum and the length of the Trace file.
+    - the number of times each stage is timed (the best time is reported).
+    - an optional JSON file to write the results to.
+    Peak memory is measured with tracemalloc in a separate, untimed run of
+    each stage.
+    Returns the results dict.
+    '''
+    tempdir = outdir is None
+    if tempdir:
+        outdir = tempfile.mkdtemp(prefix='fluorspec-bench-')
+    try:
+        gen = SyntheticExports(outdir, npoints=npoints)
+        corrfiles = gen.CorrectionFiles()
+        sets = gen.QYSets(nsets)
+        sessions = [path for s in sets for path in s]
+        trace = gen.Trace('trace.txt', tracelength)
+        reader = FluorSpec.Analyse.FluorSpecReader()
+        reader.Basepath = os.path.join(outdir, '')
+        reader.CorrFiles = corrfiles
+        results = {'meta':_Meta(nsets=nsets, npoints=npoints,
+                                tracelength=tracelength, repeats=repeats),
+                   'stages':{}}
+        def parse(paths):
+            return [FluorSpec.PTI_Data.PTI_Data(p, quiet=True) for p in paths]
+        data = parse(sessions)
+        def correct():
+            for d in data:
+                reader.ApplyCorrFileToRaw(d, 'emcorr-sphere')
+        correct()
+        triples = [data[i:i+3] for i in range(0, len(data), 3)]
+        em_start, em_end = gen.Ex + 40, gen.Ex + 300
+        scat_start, scat_end = gen.Ex - 15, gen.Ex + 15
+        normWL = gen.Ex + 200
+        def qy():
+            for fluor, solvent, dilute in triples:
+                reader.CalculateQY_2MM(fluor, solvent, scat_start, scat_end,
+                                       em_start, em_end, dilute=dilute,
+                                       normWL=normWL)
+        baselines = []
+        for fluor, solvent, dilute in triples:
+            baselines.append(reader.CalcStraightLine(
+                fluor.WL, fluor.SpecCorrected,
+                FluorSpec.Analyse._WLIndex(fluor.WL, em_start),
+                FluorSpec.Analyse._WLIndex(fluor.WL, em_end)))
+        def reabs():
+            for (fluor, solvent, dilute), BL in zip(triples, baselines):
+                reader.CalcReabsProb(fluor, em_start, em_end,
+                                     FluorSpec.Analyse._WLIndex(fluor.WL, normWL),
+                                     BL, dilute)
+        sessionbytes = sum(os.path.getsize(p) for p in sessions)
+        corrpaths = [os.path.join(outdir, p) for p in corrfiles.values() if p]
+        stages = [('parse_session', lambda: parse(sessions), len(sessions), sessionbytes),
+                  ('parse_trace', lambda: parse([trace]), tracelength,
+                   os.path.getsize(trace)),
+                  ('parse_group', lambda: parse(corrpaths), len(corrpaths),
+                   sum(os.path.getsize(p) for p in corrpaths)),
+                  ('ApplyCorrFileToRaw', correct, len(data), None),
+                  ('CalculateQY_2MM', qy, len(triples), None),
+                  ('CalcReabsProb', reabs, len(triples), None)]
+        for name, func, nitems, nbytes in stages:
+            results['stages'][name] = TimeStage(func, nitems, nbytes, repeats)
+        if jsonfile is not None:
+            with open(jsonfile, 'w') as thefile:
+                json.dump(results, thefile, indent=2, sort_keys=True)
+        return results
+    finally:
+        if tempdir and not keep:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+
+def TimeStage(func, nitems, nbytes=None, repeats=3):
+    '''
+    Time func (best of repeats), then run it once more under tracemalloc
+    for its peak memory. nitems (and nbytes, if given) are the amount of
+    work done by one call, for the throughput.
+    '''
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    if not tracing:
+        tracemalloc.stop()
+    best = min(times)
+    result = {'seconds':best, 'mean_seconds':sum(times)/len(times),
+              'repeats':repeats, 'items':nitems,
+              'items_per_second':nitems/best if best > 0 else None,
+              'peak_memory_bytes':peak}
+    if nbytes is not None:
+        result['bytes'] = nbytes
+        result['MB_per_second'] = nbytes/best/1e6 if best > 0 else None
+    return result
+
+
+def CompareBenchmarks(old, new):
+    '''
+    Ratio (new/old) of the best time and peak memory of each stage in both
+    results (dicts, or JSON file names). Ratios above 1 are regressions.
+    '''
+    if isinstance(old, str):
+        with open(old) as thefile:
+            old = json.load(thefile)
+    if isinstance(new, str):
+        with open(new) as thefile:
+            new = json.load(thefile)
+    ratios = {}
+    for name, stage in new['stages'].items():
+        if name not in old['stages']:
+            continue
+        base = old['stages'][name]
+        ratios[name] = {
+            'seconds':stage['seconds']/base['seconds'] if base['seconds'] else None,
+            'peak_memory_bytes':(stage['peak_memory_bytes']/base['peak_memory_bytes']
+                                 if base['peak_memory_bytes'] else None)}
+    return ratios
+
+
+def _Meta(**params):
+    meta = {'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python':sys.version.split()[0],
+            'numpy':np.__version__,
+            'platform':platform.platform(),
+            'processor':platform.processor()}
+    meta.update(params)
+    return meta
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark FluorSpec on synthetic PTI exports.')
+    parser.add_argument('--sets', type=int, default=50,
+                        help='number of (fluor, solvent, dilute) Session sets')
+    parser.add_argument('--points', type=int, default=501,
+                        help='number of points in each spectrum')
+    parser.add_argument('--trace', type=int, default=100000,
+                        help='number of points in the Trace file')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--dir', default=None,
+                        help='directory for the synthetic files (kept)')
+    parser.add_argument('--json', default=None, help='file to write the results to')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results (JSON) to compare with')
+    args = parser.parse_args(argv)
+    results = RunBenchmarks(args.dir, args.sets, args.points, args.trace,
+                            args.repeats, args.json, keep=args.dir is not None)
+    output = results
+    if args.compare is not None:
+        output = dict(results, compare=CompareBenchmarks(args.compare, results))
+    print(json.dumps(output, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
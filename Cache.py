@@ -0,0 +1,66 @@
+#!/usr/bin/env python2
+'''
+Small caching helpers shared by the analysis modules.
+'''
+from collections import OrderedDict
+import threading
+import numpy as np
+
+class LRUCache():
+    '''
+    A bounded least-recently-used cache that counts hits, misses and evictions.
+    It can be shared between threads.
+    '''
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def Get(self, key, default=None):
+        '''
+        Return the value for key (marking it recently used), or default.
+        '''
+        with self._lock:
+            try:
+                val = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def Put(self, key, val):
+        '''
+        Store val for key, evicting the least recently used entries if full.
+        '''
+        with self._lock:
+            self._data[key] = val
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def Clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def Stats(self):
+        with self._lock:
+            return {'hits':self.hits, 'misses':self.misses,
+                    'evictions':self.evictions, 'size':len(self._data),
+                    'maxsize':self.maxsize}
+
+
+def GridFingerprint(WL):
+    '''
+    Hashable fingerprint of a wavelength grid, for caching per-grid results.
+    '''
+    arr = np.ascontiguousarray(WL, dtype=float)
+    return (arr.size, hash(arr.tobytes()))
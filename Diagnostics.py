@@ -0,0 +1,146 @@
+#!/usr/bin/env python2
+'''
+Diagnostic plots that are recorded as data while the analysis runs and
+drawn later, so that rendering stays off the computation path.
+
+matplotlib is only imported when a figure is actually drawn.
+'''
+import os
+import re
+import threading
+import concurrent.futures
+
+class DiagnosticFigure():
+    '''
+    The description of one figure: a title, axis labels and a list of
+    (method, args, kwargs) calls on its axes, e.g.
+    ('errorbar', (WL, spec), {'yerr':uspec, 'label':'fluor spec'}).
+    The arrays are kept by reference, not copied.
+    '''
+    def __init__(self, name, title=None, xlabel=None, ylabel=None, legend=None):
+        '''
+        Arguments:
+        - a short name for the figure (used in the file name).
+        - the title and axis labels.
+        - None for no legend, or a dict of arguments for the legend.
+        '''
+        self.Name = name
+        self.Title = title
+        self.XLabel = xlabel
+        self.YLabel = ylabel
+        self.Legend = legend
+        self.Calls = []
+
+    def Add(self, method, *args, **kwargs):
+        '''
+        Record a call of an Axes method (e.g. 'plot' or 'errorbar').
+        Returns the figure, so that calls can be chained.
+        '''
+        self.Calls.append((method, args, kwargs))
+        return self
+
+    def Draw(self, ax):
+        '''
+        Draw the figure onto a matplotlib Axes.
+        '''
+        for method, args, kwargs in self.Calls:
+            getattr(ax, method)(*args, **kwargs)
+        if self.Legend is not None:
+            ax.legend(**self.Legend)
+        if self.Title is not None:
+            ax.set_title(self.Title)
+        if self.XLabel is not None:
+            ax.set_xlabel(self.XLabel)
+        if self.YLabel is not None:
+            ax.set_ylabel(self.YLabel)
+
+
+class DiagnosticsRecorder():
+    '''
+    Collects DiagnosticFigures (e.g. from a FluorSpecReader with this as its
+    Diagnostics) and renders them to image files on demand.
+
+    Recording only keeps references to the arrays; rendering is done
+    headlessly with the Agg backend, optionally in a pool of processes.
+    '''
+    def __init__(self, recordall=False):
+        '''
+        If recordall is True, a FluorSpecReader records the plots of every
+        call, not only those made with MakePlots or verbose set. Each figure
+        holds on to its arrays, so Render (or Clear) regularly.
+        '''
+        self.RecordAll = recordall
+        self.Figures = []
+        #Figures are numbered on from those already rendered.
+        self.Rendered = 0
+        self._lock = threading.Lock()
+
+    def Record(self, figure):
+        with self._lock:
+            self.Figures.append(figure)
+
+    def Clear(self):
+        with self._lock:
+            self.Figures = []
+
+    def Render(self, outdir, workers=None, fmt='png', dpi=100, clear=True,
+               wait=True):
+        '''
+        Write each recorded figure to outdir as <number>_<name>.<fmt>.
+
+        Arguments:
+        - the output directory (made if it doesn't exist).
+        - the number of processes to render in (None or 0 to render in
+          this process).
+        - the image format and resolution.
+        - whether to forget the figures once they're handed to the renderer.
+        - whether to wait for the processes to finish. If not, a list of
+          futures for the file names is returned and rendering carries on
+          in the background.
+        Returns the list of file names written.
+        '''
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        with self._lock:
+            figures = self.Figures
+            first = self.Rendered
+            if clear:
+                self.Figures = []
+                self.Rendered += len(figures)
+        jobs = [(fig, os.path.join(outdir, '{0:04d}_{1}.{2}'.format(
+                    n, _SafeName(fig.Name), fmt)), dpi)
+                for n, fig in enumerate(figures, first)]
+        if not workers:
+            return [RenderFigure(*job) for job in jobs]
+        pool = concurrent.futures.ProcessPoolExecutor(workers)
+        futures = [pool.submit(RenderFigure, *job) for job in jobs]
+        pool.shutdown(wait=wait)
+        if not wait:
+            return futures
+        return [f.result() for f in futures]
+
+
+def RenderFigure(figure, fname, dpi=100):
+    '''
+    Draw a DiagnosticFigure to an image file without a display. Returns fname.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    figure.Draw(fig.add_subplot(1, 1, 1))
+    fig.savefig(fname, dpi=dpi)
+    return fname
+
+
+def ShowFigure(figure):
+    '''
+    Draw a DiagnosticFigure in a new pyplot figure (as for interactive use).
+    '''
+    import matplotlib.pyplot as plt
+    plt.figure()
+    figure.Draw(plt.gca())
+
+
+def _SafeName(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(name))
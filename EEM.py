@@ -0,0 +1,151 @@
+#!/usr/bin/env python2
+'''
+Excitation-emission matrices (EEMs) assembled from a series of Emission
+sessions stepped in excitation wavelength.
+'''
+from collections import OrderedDict
+import logging
+import numpy as np
+import FluorSpec.PTI_Data
+import FluorSpec.Analyse
+
+_log = logging.getLogger(__name__)
+
+class EEM():
+    '''
+    An excitation-emission matrix: Matrix[i, j] is the signal at excitation
+    wavelength Ex[i] and emission wavelength Em[j], with uncertainty
+    UMatrix[i, j]. Mask is True for the points hidden by MaskScatter.
+    '''
+    def __init__(self, Ex, Em, Matrix, UMatrix, Mask=None):
+        self.Ex = np.asarray(Ex, dtype=float)
+        self.Em = np.asarray(Em, dtype=float)
+        self.Matrix = np.asarray(Matrix, dtype=float)
+        self.UMatrix = np.asarray(UMatrix, dtype=float)
+        if Mask is None:
+            Mask = np.zeros(self.Matrix.shape, dtype=bool)
+        self.Mask = np.asarray(Mask, dtype=bool)
+
+    def MaskScatter(self, width=10., rayleigh=True, secondorder=True, raman=True,
+                    ramanshift=3400., belowex=False):
+        '''
+        Mask the scatter lines (and return the mask).
+
+        Arguments:
+        - the half width (nm) of the band masked around each line.
+        - whether to mask first order Rayleigh (Em = Ex), second order
+          Rayleigh (Em = 2 Ex) and Raman scatter.
+        - the Raman shift in 1/cm (3400 for the O-H stretch of water).
+        - whether to also mask everything with Em below Ex.
+        '''
+        ex = self.Ex[:, None]
+        em = self.Em[None, :]
+        mask = np.zeros(self.Matrix.shape, dtype=bool)
+        if rayleigh:
+            mask |= np.abs(em - ex) < width
+        if secondorder:
+            mask |= np.abs(em - 2*ex) < width
+        if raman:
+            ramanwl = 1e7/(1e7/ex - ramanshift)
+            mask |= np.abs(em - ramanwl) < width
+        if belowex:
+            mask |= em < ex
+        self.Mask = mask
+        return mask
+
+    def Masked(self):
+        '''
+        The matrix with the masked points set to NaN.
+        '''
+        return np.where(self.Mask, np.nan, self.Matrix)
+
+    def Save(self, fname):
+        '''
+        Save the EEM to a single (uncompressed) .npz file.
+        '''
+        np.savez(fname, Ex=self.Ex, Em=self.Em, Matrix=self.Matrix,
+                 UMatrix=self.UMatrix, Mask=self.Mask)
+
+    @classmethod
+    def Load(cls, fname):
+        with np.load(fname) as f:
+            return cls(f['Ex'], f['Em'], f['Matrix'], f['UMatrix'], f['Mask'])
+
+    @classmethod
+    def FromSessions(cls, datalist, reader=None, emkey='emcorri', exkey='excorr',
+                     Em=None, bckgnd=0):
+        '''
+        Build an EEM from Emission sessions taken at different excitation
+        wavelengths.
+
+        Arguments:
+        - the PTI_Data objects (anything that isn't a single excitation
+          wavelength Emission session is ignored). Sessions at the same
+          excitation wavelength are averaged.
+        - the FluorSpecReader to get the correction files from (and to
+          resample with).
+        - the emission and excitation correction keys (None for no correction).
+        - the emission grid (default: that of the first session); sessions on
+          other grids are resampled onto it with the reader's Regridder.
+        - a background to subtract from the raw data (scalar, Em vector or
+          Ex x Em matrix).
+        The raw matrix is corrected in one go by the outer product of the
+        excitation and emission correction vectors.
+        Returns None if a correction can't be made.
+        '''
+        if reader is None:
+            reader = FluorSpec.Analyse.FluorSpecReader()
+        RunTypes = FluorSpec.PTI_Data.PTI_Data.RunTypes
+        sessions = [d for d in datalist
+                    if getattr(d, 'RunType', None) == RunTypes.Emission and
+                    len(d.ExRange) == 1]
+        if not sessions:
+            _log.error('ERROR!! No Emission sessions to make an EEM from.')
+            return
+        if Em is None:
+            Em = sessions[0].WL
+        Em = np.asarray(Em, dtype=float)
+        #Sum the raw spectra (and variances) at each excitation wavelength.
+        byex = OrderedDict()
+        for d in sessions:
+            #Trace exports hold the spectrum as their trace.
+            raw, uraw = FluorSpec.Analyse._RawSpec(d)
+            if raw is None:
+                _log.error('ERROR!! Bad file %s, left out of the EEM.',
+                           getattr(d, 'FilePath', None))
+                continue
+            raw, uraw = reader.Regridder.Regrid(d.WL, Em, raw, uraw)
+            entry = byex.setdefault(d.ExRange[0], [0, 0, 0])
+            entry[0] = entry[0] + raw
+            entry[1] = entry[1] + np.square(uraw)
+            entry[2] += 1
+        if not byex:
+            _log.error('ERROR!! No Emission sessions to make an EEM from.')
+            return
+        Ex = np.array(sorted(byex))
+        n = np.array([byex[ex][2] for ex in Ex], dtype=float)[:, None]
+        Raw = np.array([byex[ex][0] for ex in Ex])/n
+        URaw = np.sqrt(np.array([byex[ex][1] for ex in Ex]))/n
+
+        CorrEx = cls._CorrVector(reader, exkey, Ex, RunTypes.Excitation)
+        CorrEm = cls._CorrVector(reader, emkey, Em, RunTypes.Emission)
+        if CorrEx is None or CorrEm is None:
+            return
+        Corr = np.outer(CorrEx, CorrEm)
+        Matrix = (Raw - bckgnd)*Corr
+        UMatrix = np.sqrt(np.square(URaw) + np.abs(bckgnd))*Corr
+        return cls(Ex, Em, Matrix, UMatrix)
+
+    @staticmethod
+    def _CorrVector(reader, key, WL, runtype):
+        if key is None or key == 'default':
+            return np.ones(len(WL))
+        corr, CorrVals = reader.GetCorrVals(key, WL)
+        if corr is None:
+            _log.warning('Not correcting data.')
+            return
+        if corr.RunType != runtype:
+            _log.error('ERROR!! The correction type doesn\'t match the data type. '
+                       'Correction type = %s, data type = %s', corr.RunType, runtype)
+            return
+        return CorrVals
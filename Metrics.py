@@ -0,0 +1,208 @@
+#!/usr/bin/env python2
+'''
+Stage timings and counters for the parser and the analysis.
+
+Recording is off by default, and then each instrumented stage costs a
+single flag check. Turn it on with Enable() (or the Profile context
+manager), then get the totals with Summary() or Report(). Messages go
+through the logging module, under the 'FluorSpec' logger; with DEBUG
+enabled for it every stage is also logged as it finishes.
+
+The stages recorded are:
+- file_open, header_parse, data_parse and cache_read in PTI_Data.
+- corr_file_load and interpolation of correction files in FluorSpecReader.
+- correction, correction_batch, qy, qy_batch and reabs for the analysis
+  methods.
+The counters are files_read, files_failed and corr_cache_hits.
+'''
+import time
+import logging
+import threading
+import functools
+import contextlib
+
+logger = logging.getLogger('FluorSpec')
+
+class StageMetrics():
+    '''
+    Thread safe totals of the time spent in named stages and of named
+    counters.
+
+    Hooks are callables that are called with (stage name, seconds) as
+    each stage finishes, e.g. to feed an external profiler.
+    '''
+    def __init__(self):
+        self.Enabled = False
+        self.Hooks = []
+        #pstats.Stats of the last Profile(cprofile=True) block.
+        self.Stats = None
+        self._lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self._lock:
+            #name -> [calls, total, min, max] (seconds)
+            self.Timings = {}
+            self.Counters = {}
+
+    def Stage(self, name):
+        '''
+        Context manager that times its block as the stage name.
+        '''
+        if not self.Enabled:
+            return _NullStage
+        return _Stage(self, name)
+
+    def AddTime(self, name, seconds):
+        with self._lock:
+            entry = self.Timings.get(name)
+            if entry is None:
+                self.Timings[name] = [1, seconds, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = min(entry[2], seconds)
+                entry[3] = max(entry[3], seconds)
+        for hook in self.Hooks:
+            hook(name, seconds)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s took %.6f s', name, seconds)
+
+    def Count(self, name, n=1):
+        if not self.Enabled:
+            return
+        with self._lock:
+            self.Counters[name] = self.Counters.get(name, 0) + n
+
+    def Summary(self):
+        '''
+        A dict with the stage timings (calls, total, mean, min and max
+        seconds) and the counters.
+        '''
+        with self._lock:
+            stages = dict((name, {'calls':calls, 'total':total, 'mean':total/calls,
+                                  'min':tmin, 'max':tmax})
+                          for name, (calls, total, tmin, tmax) in self.Timings.items())
+            return {'stages':stages, 'counters':dict(self.Counters)}
+
+    def Report(self):
+        '''
+        The summary as a text table, slowest stage (by total time) first.
+        '''
+        summary = self.Summary()
+        lines = ['{0:<16}{1:>10}{2:>12}{3:>12}{4:>12}{5:>12}'.format(
+            'stage', 'calls', 'total (s)', 'mean (ms)', 'min (ms)', 'max (ms)')]
+        for name, s in sorted(summary['stages'].items(),
+                              key=lambda item: -item[1]['total']):
+            lines.append('{0:<16}{1:>10}{2:>12.4f}{3:>12.4f}{4:>12.4f}{5:>12.4f}'.format(
+                name, s['calls'], s['total'], 1e3*s['mean'], 1e3*s['min'],
+                1e3*s['max']))
+        for name, n in sorted(summary['counters'].items()):
+            lines.append('{0:<16}{1:>10}'.format(name, n))
+        return '\n'.join(lines)
+
+
+class _Stage():
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.AddTime(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullContext():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NullStage = _NullContext()
+
+#The metrics recorded by the FluorSpec modules.
+Recorder = StageMetrics()
+
+def Enable():
+    Recorder.Enabled = True
+
+def Disable():
+    Recorder.Enabled = False
+
+def Stage(name):
+    if not Recorder.Enabled:
+        return _NullStage
+    return _Stage(Recorder, name)
+
+def Count(name, n=1):
+    if Recorder.Enabled:
+        Recorder.Count(name, n)
+
+def Summary():
+    return Recorder.Summary()
+
+def Report():
+    return Recorder.Report()
+
+def Reset():
+    Recorder.Reset()
+
+def Timed(name):
+    '''
+    Decorator that records each call of the function as the stage name.
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Recorder.Enabled:
+                return func(*args, **kwargs)
+            with _Stage(Recorder, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def Profile(cprofile=False, level=logging.INFO, hook=None):
+    '''
+    Record the metrics of the enclosed block (the totals are reset first)
+    and log the report at the end.
+
+    Arguments:
+    - whether to also run cProfile; its pstats.Stats is then the Stats
+      attribute of the yielded StageMetrics.
+    - the logging level of the report.
+    - an optional hook called with (stage name, seconds) for each stage.
+    Yields the StageMetrics being recorded to.
+    '''
+    wasenabled = Recorder.Enabled
+    Recorder.Reset()
+    if hook is not None:
+        Recorder.Hooks.append(hook)
+    profiler = None
+    if cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+    Recorder.Enabled = True
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield Recorder
+    finally:
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            Recorder.Stats = pstats.Stats(profiler)
+        Recorder.Enabled = wasenabled
+        if hook is not None:
+            Recorder.Hooks.remove(hook)
+        logger.log(level, 'FluorSpec stage timings:\n%s', Recorder.Report())
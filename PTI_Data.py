@@ -6,20 +6,78 @@ TEXT data are assumed (not the .gx* nonsense).
 import os
 from enum import Enum
 import time
+import json
+import itertools
+import hashlib
+import logging
+import numpy as np
+import FluorSpec.Metrics
+
+_log = logging.getLogger(__name__)
 
 class PTI_Data:
     '''PTI spectrometer data class.'''
-    RunTypes = Enum('RunType', 'Unknown Emission Excitation Synchronous')
-    FileTypes = Enum('FileType', 'Unknown Session Trace Group')
-    def __init__(self, fname):
-        print("Initializing PTI_Data at {0}".format(time.asctime(time.localtime())))
+    #module and qualname let the enums (and so PTI_Data objects) be pickled.
+    RunTypes = Enum('RunType', 'Unknown Emission Excitation Synchronous',
+                    module=__name__, qualname='PTI_Data.RunTypes')
+    FileTypes = Enum('FileType', 'Unknown Session Trace Group',
+                     module=__name__, qualname='PTI_Data.FileTypes')
+    #Line number at which the data block starts, for the file types that can
+    #be loaded lazily (Group files need the whole file to read the header).
+    DataStartLine = {'Session':8, 'Trace':4}
+    #Attributes that are only filled in once the data block has been read.
+    DataAttributes = ('WL', 'Spec', 'SpecRaw', 'USpecRaw', 'ExCorr',
+                      'FileSpecCorrected', 'UFileSpecCorrected',
+                      'Trace', 'UTrace')
+    #Data attributes stored in the binary cache for each file type.
+    DataChannels = {'Session':('WL', 'Spec', 'SpecRaw', 'USpecRaw', 'ExCorr',
+                               'FileSpecCorrected', 'UFileSpecCorrected'),
+                    'Trace':('WL', 'Trace', 'UTrace'),
+                    'Group':('WL', 'Trace', 'UTrace')}
+    #Header attributes stored in the binary cache.
+    HeaderAttributes = ('PMTmode', 'NumSamples', 'ExRange', 'EmRange',
+                        'SuccessfullyRead', 'Messages')
+    CacheMagic = b'PTICACHE'
+    CacheVersion = 1
+    def __init__(self, fname, lazy=False, quiet=False, cache=None):
+        '''
+        Read the file at fname.
+
+        If lazy is True only the header is read now; the spectral data are
+        read (by seeking to the end of the header) the first time one of the
+        data attributes is accessed.
+        Errors and warnings are kept in the Messages list, and logged (to the
+        'FluorSpec.PTI_Data' logger) unless quiet is True.
+        If cache is True (or a directory name) the parsed file is kept in a
+        binary cache file next to fname (or in that directory), which is used
+        instead of the text file as long as the file's size and mtime don't
+        change. The cached arrays are read in one block, without parsing.
+        '''
+        self.Quiet = quiet
+        self.Messages = []
+        if not quiet:
+            _log.debug("Initializing PTI_Data for %s", fname)
         #Get the file as an object.
         self.FilePath = fname
+        self._DataOffset = None
+        self._CachePath = None
         if not os.path.exists(fname):
-            print("ERROR!! File does not exist.")
+            self._Message("ERROR!! File does not exist.")
             self.SuccessfullyRead = False            
+            FluorSpec.Metrics.Count('files_failed')
             return
-        with open(self.FilePath, 'r') as thefile:
+        if cache:
+            self._CachePath = CacheFileName(fname, cache)
+            with FluorSpec.Metrics.Stage('cache_read'):
+                cached = self._ReadCache()
+            if cached:
+                self.SpecCorrected = None
+                self.USpecCorrected = None
+                FluorSpec.Metrics.Count('files_read' if self.SuccessfullyRead
+                                        else 'files_failed')
+                return
+        #Read the file once; the header and data parsers work on the lines.
+        with FluorSpec.Metrics.Stage('file_open'), open(self.FilePath, 'r') as thefile:
             firstline = thefile.readline()
             if '<Session>' in firstline:
                 self.FileType = self.FileTypes.Session
@@ -28,29 +86,157 @@ class PTI_Data:
             elif '<Group>' in firstline:
                 self.FileType = self.FileTypes.Group
             else:
-                print("ERROR!! Unknown file format.")
+                self._Message("ERROR!! Unknown file format.")
                 self.FileType = self.FileTypes.Unknown
                 self.SuccessfullyRead = False
+                FluorSpec.Metrics.Count('files_failed')
                 return
+            lines = [firstline.rstrip('\r\n')]
+            nhdr = self.DataStartLine.get(self.FileType.name)
+            if lazy and nhdr is not None:
+                lines += [thefile.readline().rstrip('\r\n') for i in range(nhdr-1)]
+                self._DataOffset = thefile.tell()
+            else:
+                lines += thefile.read().splitlines()
 
-        self.SuccessfullyRead = self.ReadHeaderInfo()
-        self.WL = [0]*self.NumSamples
-        if self.FileType == self.FileTypes.Session:
-            self.Spec = [0]*self.NumSamples
-            self.SpecRaw = [0]*self.NumSamples
-            self.USpecRaw = [0]*self.NumSamples
-            self.ExCorr = [0]*self.NumSamples #Note ExCorr here is the photodiode signal.
-            self.FileSpecCorrected = [0]*self.NumSamples
-            self.UFileSpecCorrected = [0]*self.NumSamples
-        elif self.FileType.value > 1:
-            self.Trace = [0]*self.NumSamples
-            self.UTrace = [0]*self.NumSamples
-        
-        self.ReadSpecData()
+        with FluorSpec.Metrics.Stage('header_parse'):
+            self.SuccessfullyRead = self.ReadHeaderInfo(lines)
+        if self._DataOffset is None:
+            with FluorSpec.Metrics.Stage('data_parse'):
+                self.ReadSpecData(lines)
+            self._WriteCache()
         self.SpecCorrected = None
         self.USpecCorrected = None
+        FluorSpec.Metrics.Count('files_read' if self.SuccessfullyRead
+                                else 'files_failed')
+        return
+
+    def __getattr__(self, name):
+        #Only called for missing attributes: read the data of a lazy object.
+        if name in PTI_Data.DataAttributes and \
+           self.__dict__.get('_DataOffset') is not None:
+            self._LoadData()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def Compact(self, dtype=np.float64):
+        '''
+        Return a CompactPTI_Data copy of this object, with all the data in
+        one array of the given dtype (e.g. np.float32 to halve the memory).
+        '''
+        return CompactPTI_Data(self, dtype)
+
+    def IsLoaded(self):
+        '''
+        False if the data of a lazily constructed object have not been read yet.
+        '''
+        return self.__dict__.get('_DataOffset') is None
+
+    def _LoadData(self):
+        '''
+        Read the data block of a lazily constructed object, starting from the
+        byte offset remembered when the header was read.
+        '''
+        offset = self._DataOffset
+        self._DataOffset = None
+        with open(self.FilePath, 'r') as thefile:
+            thefile.seek(offset)
+            lines = thefile.read().splitlines()
+        with FluorSpec.Metrics.Stage('data_parse'):
+            self.ReadSpecData(['']*self.DataStartLine[self.FileType.name] + lines)
+        self._WriteCache()
         return
 
+    def _CacheKey(self):
+        st = os.stat(self.FilePath)
+        return {'Version':self.CacheVersion, 'Source':os.path.abspath(self.FilePath),
+                'Size':st.st_size, 'MTime':st.st_mtime}
+
+    def _ReadCache(self):
+        '''
+        Set everything from the binary cache file, if it is up to date.
+        Returns False if there is no usable cache file (nothing is set then,
+        and the text file is parsed instead).
+        '''
+        if not os.path.exists(self._CachePath):
+            return False
+        try:
+            with open(self._CachePath, 'rb') as thefile:
+                if thefile.read(len(self.CacheMagic)) != self.CacheMagic:
+                    return False
+                hdrlen = int(np.frombuffer(thefile.read(8), dtype='<i8')[0])
+                hdr = json.loads(thefile.read(hdrlen).decode('utf-8'))
+                if any(hdr.get(k) != v for k, v in self._CacheKey().items()):
+                    return False
+                channels = hdr['Channels']
+                shape = (len(channels), hdr['Length'])
+                #Read (rather than map) the arrays, so that no file stays open.
+                arr = np.fromfile(thefile, dtype='<f8', count=shape[0]*shape[1])
+            arr = arr.reshape(shape)
+            FileType = self.FileTypes[hdr['FileType']]
+            RunType = None
+            if hdr['RunType'] is not None:
+                RunType = self.RunTypes[hdr['RunType']]
+            AcqStart = time.struct_time(hdr['AcqStart'])
+        except (OSError, ValueError, IndexError, KeyError, TypeError) as e:
+            self._Message("Warning: Could not read cache file {0}: {1}".format(
+                self._CachePath, e))
+            return False
+        self.FileType = FileType
+        if RunType is not None:
+            self.RunType = RunType
+        self.AcqStart = AcqStart
+        for name in self.HeaderAttributes:
+            if name in hdr:
+                setattr(self, name, hdr[name])
+        for i, name in enumerate(channels):
+            setattr(self, name, arr[i])
+        return True
+
+    def _WriteCache(self):
+        '''
+        Write the header and data to the binary cache file (if one was asked for).
+        The file is written to a temporary name and renamed into place.
+        '''
+        if self._CachePath is None or not self.SuccessfullyRead:
+            return
+        channels = self.DataChannels[self.FileType.name]
+        arr = np.array([getattr(self, name) for name in channels], dtype='<f8')
+        hdr = self._CacheKey()
+        hdr.update({'FileType':self.FileType.name,
+                    'RunType':self.RunType.name if hasattr(self, 'RunType') else None,
+                    'AcqStart':list(self.AcqStart), 'Channels':list(channels),
+                    'Length':arr.shape[1]})
+        for name in self.HeaderAttributes:
+            if hasattr(self, name):
+                hdr[name] = getattr(self, name)
+        hdr = json.dumps(hdr).encode('utf-8')
+        #Pad the header so that the array starts on a 64 byte boundary.
+        hdr += b' '*(-(len(self.CacheMagic) + 8 + len(hdr)) % 64)
+        tmppath = '{0}.{1}.tmp'.format(self._CachePath, os.getpid())
+        try:
+            with open(tmppath, 'wb') as thefile:
+                thefile.write(self.CacheMagic)
+                thefile.write(np.array([len(hdr)], dtype='<i8').tobytes())
+                thefile.write(hdr)
+                thefile.write(arr.tobytes())
+            os.replace(tmppath, self._CachePath)
+        except OSError as e:
+            self._Message("Warning: Could not write cache file {0}: {1}".format(
+                self._CachePath, e))
+        return
+
+    def _Message(self, msg):
+        '''
+        Keep an error or warning message, and log it unless quiet.
+        '''
+        self.Messages.append(msg)
+        if not self.Quiet:
+            if msg.startswith('ERROR'):
+                _log.error('%s: %s', self.FilePath, msg)
+            else:
+                _log.warning('%s: %s', self.FilePath, msg)
+
     def RegisterCorrSpec(self, CorrSpec, UCorrSpec):
         '''
         Define the SpecCorrected and USpecCorrected members.
@@ -59,10 +245,11 @@ class PTI_Data:
         self.USpecCorrected = UCorrSpec
         return
 
-    def ReadHeaderInfo(self):
+    def ReadHeaderInfo(self, lines=None):
         '''
         Read the header (first 7 lines) and extract useful info.
-        This is called in initialization.
+        This is called in initialization, with the lines already read from
+        the file; if lines is None the file is opened and read here.
         
         Useful info that is set:
         - Start date and time (as a time struct).
@@ -72,13 +259,15 @@ class PTI_Data:
         - Run type (from RunTypes enum).
         '''
         #Read the header info to determine the run type
-        with open(self.FilePath, 'r') as thefile:
-            if self.FileType == self.FileTypes.Session:
-                success = self._ReadHdrSession(thefile)
-            elif self.FileType == self.FileTypes.Trace:
-                success = self._ReadHdrTrace(thefile)
-            elif self.FileType == self.FileTypes.Group:
-                success = self._ReadHdrGroup(thefile)
+        if lines is None:
+            with open(self.FilePath, 'r') as thefile:
+                lines = thefile.read().splitlines()
+        if self.FileType == self.FileTypes.Session:
+            success = self._ReadHdrSession(lines)
+        elif self.FileType == self.FileTypes.Trace:
+            success = self._ReadHdrTrace(lines)
+        elif self.FileType == self.FileTypes.Group:
+            success = self._ReadHdrGroup(lines)
         return success
         
     def _ReadHdrSession(self, thefile):
@@ -126,7 +315,7 @@ class PTI_Data:
                 elif self.RunType == self.RunTypes.Emission:
                     self.EmRange = [float(wrds[0])]
                 else:
-                    print("ERROR!! Bad correction file (the names need excorr or emcorr).")
+                    self._Message("ERROR!! Bad correction file (the names need excorr or emcorr).")
                     success = False
                     break
             elif i==6+self.NumSamples-1:
@@ -161,9 +350,11 @@ class PTI_Data:
             success = False
         return success
 
-    def ReadSpecData(self):
+    def ReadSpecData(self, lines=None):
         '''
-        Read the data from the file.
+        Read the data from the file (or from lines, if already read).
+        The numeric blocks are located from the header counts and converted
+        to numpy arrays in bulk; uncertainties are sqrt(|counts|).
         
         If the file is a trace, this will read:
         - WL (list of wavelengths)
@@ -173,53 +364,164 @@ class PTI_Data:
         - SpecRaw (uncorrected for excitation/emission)
         - ExCorr (the excitation correction data from the photodiode)
         '''
+        if lines is None:
+            with open(self.FilePath, 'r') as thefile:
+                lines = thefile.read().splitlines()
         if self.FileType == self.FileTypes.Session:
-            self._ReadSessionData()
+            self._ReadSessionData(lines)
         elif self.FileType == self.FileTypes.Trace:
-            self._ReadTraceData()
+            self._ReadTraceData(lines)
         elif self.FileType == self.FileTypes.Group:
-            self._ReadGroupData()
+            self._ReadGroupData(lines)
         return
-        
-    def _ReadSessionData(self):
-        NoCorr = False
-        with open(self.FilePath, 'r') as thefile:
-            for i, line in enumerate(thefile):
-                if i > 7 and i < (8 + self.NumSamples):
-                    wrds = line.split()
-                    self.WL[i-8] = float(wrds[0])
-                    self.SpecRaw[i-8] = float(wrds[1])
-                    self.USpecRaw[i-8] = abs(float(wrds[1]))**(0.5)
-                    self.FileSpecCorrected[i-8] = float(wrds[-1])
-                    self.UFileSpecCorrected[i-8] = abs(float(wrds[-1]))**(0.5)
-                    try:
-                        self.Spec[i-8] = float(wrds[3])
-                    except IndexError:
-                        NoCorr = True
-                elif i > (8 + self.NumSamples + 7) and \
-                   i < (8 + self.NumSamples + 7 + self.NumSamples):
-                    wrds = line.split()
-                    self.ExCorr[i-(8+self.NumSamples+7)] += float(wrds[1])
+
+    def _ReadSessionData(self, lines):
+        N = self.NumSamples
+        self.WL = np.zeros(N)
+        self.Spec = np.zeros(N)
+        self.SpecRaw = np.zeros(N)
+        self.ExCorr = np.zeros(N) #Note ExCorr here is the photodiode signal.
+        self.FileSpecCorrected = np.zeros(N)
+        block, counts = _ParseBlock(lines[8:8+N])
+        n = len(counts)
+        if n > 0:
+            self.WL[:n] = block[:,0]
+            self.SpecRaw[:n] = block[:,1]
+            self.FileSpecCorrected[:n] = block[np.arange(n), counts-1]
+            if block.shape[1] > 3:
+                self.Spec[:n] = np.where(counts > 3, block[:,3], 0)
+            NoCorr = np.any(counts < 4)
+        else:
+            NoCorr = False
+        #The photodiode block follows 7 lines after the spectrum; as before,
+        #its first line is skipped so ExCorr[0] stays zero.
+        block, counts = _ParseBlock(lines[8+N+8:8+N+7+N])
+        self.ExCorr[1:1+len(counts)] = block[:,1] if len(counts) else 0
+        self.USpecRaw = np.sqrt(np.abs(self.SpecRaw))
+        self.UFileSpecCorrected = np.sqrt(np.abs(self.FileSpecCorrected))
         if NoCorr:
-            print("Warning: No Corrected Spectrum was found in this session file!")
+            self._Message("Warning: No Corrected Spectrum was found in this session file!")
         return
 
-    def _ReadTraceData(self):
-        with open(self.FilePath, 'r') as thefile:
-            for i, line in enumerate(thefile):
-                if i > 3 and i < (4 + self.NumSamples):
-                    wrds = line.split()
-                    self.WL[i-4] = float(wrds[0])
-                    self.Trace[i-4] = float(wrds[1])
-                    self.UTrace[i-4] = abs(float(wrds[1]))**(0.5)
+    def _ReadTraceData(self, lines):
+        self._ReadXYBlock(lines[4:4+self.NumSamples])
         return
 
-    def _ReadGroupData(self):
-        with open(self.FilePath, 'r') as thefile:
-            for i, line in enumerate(thefile):
-                if i > 5 and i < (6 + self.NumSamples):
-                    wrds = line.split()
-                    self.WL[i-6] = float(wrds[0])
-                    self.Trace[i-6] = float(wrds[1])
-                    self.UTrace[i-6] = abs(float(wrds[1]))**(0.5)
+    def _ReadGroupData(self, lines):
+        self._ReadXYBlock(lines[6:6+self.NumSamples])
+        return
+
+    def _ReadXYBlock(self, lines):
+        self.WL = np.zeros(self.NumSamples)
+        self.Trace = np.zeros(self.NumSamples)
+        block, counts = _ParseBlock(lines)
+        n = len(counts)
+        if n > 0:
+            self.WL[:n] = block[:,0]
+            self.Trace[:n] = block[:,1]
+        self.UTrace = np.sqrt(np.abs(self.Trace))
         return
+
+
+class CompactPTI_Data(object):
+    '''
+    Compact, array-backed version of a PTI_Data object.
+
+    All the data channels (and SpecCorrected/USpecCorrected) are rows of a
+    single 2-D array, Data, optionally float32, and the object has no
+    per-instance __dict__. The usual attribute names (WL, SpecRaw, Trace,
+    ...) are views of the rows, so the analysis code works unchanged.
+    Assigning to them, or registering a corrected spectrum, copies the
+    values into the array.
+    '''
+    __slots__ = ('FilePath', 'FileType', 'RunType', 'PMTmode', 'AcqStart',
+                 'NumSamples', 'ExRange', 'EmRange', 'SuccessfullyRead',
+                 'Messages', 'Data', 'Channels', '_HasCorr')
+    RunTypes = PTI_Data.RunTypes
+    FileTypes = PTI_Data.FileTypes
+    HeaderSlots = ('FilePath', 'FileType', 'RunType', 'PMTmode', 'AcqStart',
+                   'NumSamples', 'ExRange', 'EmRange', 'SuccessfullyRead',
+                   'Messages')
+
+    def __init__(self, data, dtype=np.float64):
+        '''
+        Copy the header and data of the PTI_Data object data.
+        '''
+        for name in self.HeaderSlots:
+            if hasattr(data, name):
+                setattr(self, name, getattr(data, name))
+        self.Channels = PTI_Data.DataChannels[data.FileType.name] + \
+                        ('SpecCorrected', 'USpecCorrected')
+        self.Data = np.zeros((len(self.Channels), len(data.WL)), dtype=dtype)
+        for i, name in enumerate(self.Channels[:-2]):
+            self.Data[i] = getattr(data, name)
+        self._HasCorr = False
+        if getattr(data, 'SpecCorrected', None) is not None:
+            self.RegisterCorrSpec(data.SpecCorrected, data.USpecCorrected)
+
+    def RegisterCorrSpec(self, CorrSpec, UCorrSpec):
+        '''
+        Define the SpecCorrected and USpecCorrected members.
+        '''
+        self.Data[-2] = CorrSpec
+        self.Data[-1] = UCorrSpec
+        self._HasCorr = True
+        return
+
+    def IsLoaded(self):
+        return True
+
+
+def _ChannelProperty(name):
+    def get(self):
+        if name in ('SpecCorrected', 'USpecCorrected') and not self._HasCorr:
+            return None
+        try:
+            return self.Data[self.Channels.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+    def set(self, value):
+        try:
+            self.Data[self.Channels.index(name)] = value
+        except ValueError:
+            raise AttributeError(name)
+    return property(get, set)
+
+for _name in PTI_Data.DataAttributes + ('SpecCorrected', 'USpecCorrected'):
+    setattr(CompactPTI_Data, _name, _ChannelProperty(_name))
+
+
+def _ParseBlock(lines):
+    '''
+    Convert a block of whitespace-delimited text lines to a 2-D float array.
+
+    Returns the array and the number of fields on each row. Rows are
+    normally all the same width and are converted in one go; ragged rows
+    are padded with NaN.
+    '''
+    n = len(lines)
+    if n == 0:
+        return np.zeros((0, 0)), np.zeros(0, dtype=int)
+    rows = [line.split() for line in lines]
+    counts = np.fromiter(map(len, rows), dtype=int, count=n)
+    width = counts[0]
+    #Only rows that are all the same width can be converted in one go (a
+    #total field count of n*width doesn't mean that).
+    if width > 0 and np.all(counts == width):
+        words = list(itertools.chain.from_iterable(rows))
+        return np.array(words, dtype=float).reshape(n, width), counts
+    block = np.full((n, max(counts.max(), 2)), np.nan)
+    for i, row in enumerate(rows):
+        block[i, :len(row)] = np.array(row, dtype=float)
+    return block, counts
+
+
+def CacheFileName(fname, cachedir=True):
+    '''
+    Name of the binary cache file for the PTI export fname: next to it if
+    cachedir is True, otherwise in the directory cachedir.
+    '''
+    if cachedir is True:
+        return fname + '.pticache'
+    tag = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cachedir, '{0}-{1}.pticache'.format(os.path.basename(fname), tag))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python2
+'''
+Resample spectra (and their uncertainties) from one wavelength grid onto
+another, many at a time.
+'''
+from collections import OrderedDict
+import numpy as np
+import FluorSpec.Cache
+
+class Regridder():
+    '''
+    Resample spectra onto a target wavelength grid.
+
+    Resampling is a matrix product: the spectra on a source grid (one per
+    row) are multiplied by a weight matrix for the (source, target) pair of
+    grids, and the uncertainties are propagated through the same weights
+    (assuming the source points are independent). The weight matrices are
+    cached, so that a grid pair met again costs a single matrix product.
+
+    Modes:
+    - 'linear': linear interpolation, as np.interp (points off the ends of
+      the source grid take the end values).
+    - 'flux': each point is taken as the centre of a bin reaching halfway
+      to its neighbours, and a target bin gets the mean of the source bins
+      over the part of it they cover. The integral over wavelength is
+      conserved, so use this for broad or coarse target grids.
+    In flux mode the target points the source grid doesn't cover at all are
+    NaN; in either mode they can be set to a fill value instead.
+    '''
+    Modes = ('linear', 'flux')
+
+    def __init__(self, cachesize=32):
+        '''
+        Optionally set the number of weight matrices kept in memory.
+        '''
+        self.WeightsCache = FluorSpec.Cache.LRUCache(cachesize)
+
+    def Weights(self, source, target, mode='linear'):
+        '''
+        Return the (len(target) x len(source)) weight matrix for the pair of
+        (ascending) grids and a boolean array of the target points outside
+        the source grid. These are shared, so don't modify them.
+        '''
+        if mode not in self.Modes:
+            raise ValueError('Unknown regrid mode {0}, use one of {1}'.format(
+                mode, self.Modes))
+        source = np.asarray(source, dtype=float)
+        target = np.asarray(target, dtype=float)
+        key = (FluorSpec.Cache.GridFingerprint(source),
+               FluorSpec.Cache.GridFingerprint(target), mode)
+        entry = self.WeightsCache.Get(key)
+        if entry is None:
+            if mode == 'linear':
+                entry = _LinearWeights(source, target)
+            else:
+                entry = _FluxWeights(source, target)
+            self.WeightsCache.Put(key, entry)
+        return entry
+
+    def Regrid(self, source, target, values, uncertainties=None, mode='linear',
+               fill=None):
+        '''
+        Resample values (a spectrum, or one spectrum per row) from the
+        source grid onto the target grid.
+
+        Returns the resampled values and uncertainties (None if no
+        uncertainties are given). Spectra already on the target grid are
+        returned as they are.
+        '''
+        values = np.asarray(values, dtype=float)
+        if FluorSpec.Cache.GridFingerprint(source) == \
+           FluorSpec.Cache.GridFingerprint(target):
+            if uncertainties is not None:
+                uncertainties = np.asarray(uncertainties, dtype=float)
+            return values, uncertainties
+        W, outside = self.Weights(source, target, mode)
+        out = np.dot(values, W.T)
+        uout = None
+        if uncertainties is not None:
+            uout = np.sqrt(np.dot(np.square(uncertainties), np.square(W).T))
+        if fill is not None and np.any(outside):
+            out[..., outside] = fill
+            if uout is not None:
+                uout[..., outside] = 0
+        return out, uout
+
+    def RegridData(self, datalist, target, mode='linear', fill=None,
+                   attr='SpecCorrected'):
+        '''
+        Resample a spectrum attribute (e.g. 'SpecCorrected' or 'SpecRaw',
+        with its 'U' uncertainty) of a list of PTI_Data objects.
+
+        target is either one grid for all of them or a list with a grid for
+        each. The spectra are grouped by (source, target) pair and each group
+        is resampled in one matrix product.
+
+        Returns N x M arrays of values and uncertainties, padded with NaN to
+        the longest target grid.
+        '''
+        if len(target) > 0 and np.ndim(target[0]) == 0:
+            targets = [target]*len(datalist)
+        else:
+            targets = list(target)
+        if len(targets) != len(datalist):
+            raise ValueError('Got {0} target grids for {1} spectra'.format(
+                len(targets), len(datalist)))
+        lengths = [len(t) for t in targets]
+        M = max(lengths) if lengths else 0
+        out = np.full((len(datalist), M), np.nan)
+        uout = np.full((len(datalist), M), np.nan)
+        groups = OrderedDict()
+        for i, (data, grid) in enumerate(zip(datalist, targets)):
+            key = (FluorSpec.Cache.GridFingerprint(data.WL),
+                   FluorSpec.Cache.GridFingerprint(grid))
+            groups.setdefault(key, []).append(i)
+        for rows in groups.values():
+            source = datalist[rows[0]].WL
+            grid = targets[rows[0]]
+            values = np.array([getattr(datalist[i], attr) for i in rows], dtype=float)
+            uvalues = np.array([getattr(datalist[i], 'U' + attr) for i in rows],
+                               dtype=float)
+            values, uvalues = self.Regrid(source, grid, values, uvalues, mode, fill)
+            out[rows, :len(grid)] = values
+            uout[rows, :len(grid)] = uvalues
+        return out, uout
+
+    def CacheStats(self):
+        return self.WeightsCache.Stats()
+
+    def ClearCache(self):
+        self.WeightsCache.Clear()
+
+
+def _LinearWeights(source, target):
+    '''
+    Linear interpolation weights, with the np.interp treatment of the ends.
+    '''
+    W = np.zeros((len(target), len(source)))
+    outside = (target < source[0]) | (target > source[-1])
+    if len(source) == 1:
+        W[:, 0] = 1
+        return W, outside
+    idx = np.clip(np.searchsorted(source, target), 1, len(source)-1)
+    frac = np.clip((target - source[idx-1])/(source[idx] - source[idx-1]), 0, 1)
+    rows = np.arange(len(target))
+    W[rows, idx-1] = 1 - frac
+    W[rows, idx] += frac
+    return W, outside
+
+
+def _BinEdges(WL):
+    '''
+    Edges of bins centred on the grid points, halfway between neighbours.
+    '''
+    if len(WL) == 1:
+        return np.array([WL[0] - 0.5, WL[0] + 0.5])
+    mid = (WL[1:] + WL[:-1])/2
+    return np.concatenate(([WL[0] - (mid[0] - WL[0])], mid,
+                           [WL[-1] + (WL[-1] - mid[-1])]))
+
+
+def _FluxWeights(source, target):
+    '''
+    Bin overlap weights, normalised by the part of each target bin covered.
+    '''
+    src = _BinEdges(source)
+    tgt = _BinEdges(target)
+    overlap = np.clip(np.minimum(tgt[1:, None], src[None, 1:]) -
+                      np.maximum(tgt[:-1, None], src[None, :-1]), 0, None)
+    covered = np.sum(overlap, axis=1)
+    outside = covered == 0
+    W = overlap/np.where(outside, 1, covered)[:, None]
+    W[outside] = np.nan
+    return W, outside
@@ -0,0 +1,364 @@
+#!/usr/bin/env python2
+'''
+A long-running local analysis service wrapping FluorSpecReader.
+
+The server keeps parsed and corrected PTI_Data objects in LRU caches (as
+well as the reader's correction file caches), so that the reference
+solvent and dilute spectra shared by many jobs are only read and
+corrected once. It listens on localhost (HTTP) or on a Unix socket, and
+takes batches of JSON jobs that are run by a pool of worker threads.
+
+Start it with python -m FluorSpec.Server (see --help), and send jobs with
+Request, or POST {"jobs": [...]} to /batch with any HTTP client.
+'''
+import os
+import copy
+import json
+import socket
+import logging
+import threading
+import socketserver
+import http.server
+import http.client
+import concurrent.futures
+import numpy as np
+import FluorSpec.PTI_Data
+import FluorSpec.Analyse
+import FluorSpec.Cache
+import FluorSpec.Metrics
+
+_log = logging.getLogger(__name__)
+
+class AnalysisServer():
+    '''
+    Serve correction, QY and reabsorption jobs on a warm FluorSpecReader.
+
+    Each job is a dict with an 'op' and its arguments. File arguments are
+    paths of PTI exports, which are corrected with the job's 'key' (and the
+    optional 'extracorr' synchronous scan path, 'bckgnd' and 'factor', as
+    for FluorSpecReader.ApplyCorrFileToRaw). The ops are:
+    - correct: {'file'} -> WL, SpecCorrected, USpecCorrected.
+    - qy: {'fluor', 'solvent', 'scat': [start, end], 'em': [start, end],
+      optional 'dilute', 'normWL', 'use_solvent_BL', 'avglen'} -> QY, UQY
+      (from CalculateQY_2MM).
+    - reabs: {'sphere', 'dilute', 'em': [start, end], 'normWL', optional
+      'solvent' (for the baseline, otherwise a straight line is fitted)
+      and 'avglen'} -> w, Uw (from CalcReabsProb).
+    - stats: the cache statistics and the Metrics summary.
+    Each result has 'ok' set, and 'error' if the job failed; a failed job
+    doesn't affect the others in its batch.
+    '''
+    def __init__(self, reader=None, workers=4, datacachesize=256,
+                 corrcachesize=256, roots=None):
+        '''
+        Arguments:
+        - the FluorSpecReader to use (for its correction files and caches).
+        - the number of worker threads the jobs of a batch are shared among.
+        - the numbers of parsed and of corrected PTI_Data objects to keep.
+        - an optional list of directories; if given, only files under them
+          are read.
+        '''
+        self.Reader = reader if reader is not None else FluorSpec.Analyse.FluorSpecReader()
+        self.Workers = workers
+        #(path, mtime, size) -> PTI_Data
+        self.DataCache = FluorSpec.Cache.LRUCache(datacachesize)
+        #(file stamp, key, extracorr stamp, bckgnd, factor) -> corrected PTI_Data
+        self.CorrectedCache = FluorSpec.Cache.LRUCache(corrcachesize)
+        self.Roots = None if roots is None else [os.path.join(os.path.realpath(r), '')
+                                                 for r in roots]
+        self.Ops = {'correct':self._Correct, 'qy':self._QY, 'reabs':self._Reabs,
+                    'stats':self._Stats}
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._server = None
+        self._thread = None
+
+    def Run(self, jobs):
+        '''
+        Run a list of jobs on the worker pool and return their results, in
+        order.
+        '''
+        return list(self._pool.map(self.RunJob, jobs))
+
+    def RunJob(self, job):
+        try:
+            op = self.Ops.get(job.get('op'))
+            if op is None:
+                raise ValueError('Unknown op {0}'.format(job.get('op')))
+            with FluorSpec.Metrics.Stage('server_' + job['op']):
+                result = op(job)
+            result['ok'] = True
+        except Exception as e:
+            FluorSpec.Metrics.Count('server_jobs_failed')
+            result = {'ok':False, 'error':'{0}: {1}'.format(type(e).__name__, e)}
+        if isinstance(job, dict) and 'id' in job:
+            result['id'] = job['id']
+        return result
+
+    def GetData(self, path):
+        '''
+        The parsed PTI_Data object for path, from the cache if the file
+        hasn't changed. It's shared, so don't modify it.
+        '''
+        stamp = self._Stamp(path)
+        data = self.DataCache.Get(stamp)
+        if data is None:
+            data = FluorSpec.PTI_Data.PTI_Data(stamp[0], quiet=True)
+            if not data.SuccessfullyRead:
+                raise IOError('Could not read {0}: {1}'.format(path, data.Messages))
+            self.DataCache.Put(stamp, data)
+        return data
+
+    def GetCorrected(self, path, job):
+        '''
+        A (shared) copy of the PTI_Data object for path with the correction
+        given by the job registered, from the cache if possible.
+        '''
+        extracorr = job.get('extracorr')
+        bckgnd = job.get('bckgnd', 0)
+        factor = job.get('factor')
+        key = (self._Stamp(path), job.get('key', 'default'),
+               None if extracorr is None else self._Stamp(extracorr),
+               json.dumps(bckgnd), json.dumps(factor))
+        data = self.CorrectedCache.Get(key)
+        if data is None:
+            #Register the correction on a shallow copy, so that the parsed
+            #object stays as it was read.
+            data = copy.copy(self.GetData(path))
+            result = self.Reader.ApplyCorrFileToRaw(
+                data, key[1], bckgnd=np.asarray(bckgnd, dtype=float),
+                extracorr=None if extracorr is None else self.GetData(extracorr),
+                factor=factor)
+            if result is None:
+                raise ValueError('Could not correct {0} with {1}'.format(path, key[1]))
+            self.CorrectedCache.Put(key, data)
+        return data
+
+    def CacheStats(self):
+        stats = self.Reader.CacheStats()
+        stats['Data'] = self.DataCache.Stats()
+        stats['Corrected'] = self.CorrectedCache.Stats()
+        stats['Regrid'] = self.Reader.Regridder.CacheStats()
+        return stats
+
+    def _Stamp(self, path):
+        path = os.path.realpath(path)
+        if self.Roots is not None and \
+           not any(path.startswith(root) for root in self.Roots):
+            raise ValueError('{0} is not under the allowed directories'.format(path))
+        st = os.stat(path)
+        return (path, st.st_mtime, st.st_size)
+
+    def _Correct(self, job):
+        data = self.GetCorrected(job['file'], job)
+        return {'WL':data.WL, 'SpecCorrected':data.SpecCorrected,
+                'USpecCorrected':data.USpecCorrected}
+
+    def _QY(self, job):
+        fluor = self.GetCorrected(job['fluor'], job)
+        solvent = self.GetCorrected(job['solvent'], job)
+        dilute = None
+        if job.get('dilute') is not None:
+            dilute = self.GetCorrected(job['dilute'], job)
+        QY, UQY = self.Reader.CalculateQY_2MM(
+            fluor, solvent, job['scat'][0], job['scat'][1], job['em'][0], job['em'][1],
+            use_solvent_BL=job.get('use_solvent_BL', False), dilute=dilute,
+            normWL=job.get('normWL'), avglen=job.get('avglen', 4))
+        return {'QY':QY, 'UQY':UQY}
+
+    def _Reabs(self, job):
+        sphere = self.GetCorrected(job['sphere'], job)
+        dilute = self.GetCorrected(job['dilute'], job)
+        em_start, em_end = job['em']
+        if job.get('solvent') is not None:
+            solvent = self.GetCorrected(job['solvent'], job)
+            Em_BL = self.Reader.Regridder.Regrid(solvent.WL, sphere.WL,
+                                                 solvent.SpecCorrected)[0]
+        else:
+            Em_BL = self.Reader.CalcStraightLine(
+                sphere.WL, sphere.SpecCorrected,
+                FluorSpec.Analyse._WLIndex(sphere.WL, em_start),
+                FluorSpec.Analyse._WLIndex(sphere.WL, em_end),
+                avglen=job.get('avglen', 4))
+        w, Uw = self.Reader.CalcReabsProb(
+            sphere, em_start, em_end, FluorSpec.Analyse._WLIndex(sphere.WL, job['normWL']),
+            Em_BL, dilute)
+        return {'w':w, 'Uw':Uw}
+
+    def _Stats(self, job):
+        return {'caches':self.CacheStats(), 'metrics':FluorSpec.Metrics.Summary()}
+
+    def Serve(self, address=('127.0.0.1', 8765)):
+        '''
+        Serve requests until interrupted. address is a (host, port) pair or
+        the path of a Unix socket.
+        '''
+        self.Start(address)
+        try:
+            self._thread.join()
+        except KeyboardInterrupt:
+            pass
+        self.Stop()
+
+    def Start(self, address=('127.0.0.1', 8765)):
+        '''
+        Start serving in a background thread; returns the bound address.
+        '''
+        if isinstance(address, str):
+            _CheckUnixSockets()
+            if os.path.exists(address):
+                os.remove(address)
+            self._server = _UnixHTTPServer(address, _Handler)
+        else:
+            self._server = _TCPHTTPServer(tuple(address), _Handler)
+        self._server.Analysis = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        _log.info('Serving on %s', self._server.server_address)
+        return self._server.server_address
+
+    def Stop(self):
+        '''
+        Stop serving and shut down the worker pool.
+        '''
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if isinstance(self._server.server_address, str):
+                os.remove(self._server.server_address)
+            self._server = None
+        self._pool.shutdown()
+
+
+class _TCPHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+#There are no Unix sockets on Windows.
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def _CheckUnixSockets():
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socketserver, 'UnixStreamServer'):
+        raise ValueError('Unix sockets are not available on this platform, '
+                         'use a (host, port) address instead.')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    GET /health, GET /stats and POST /batch with {"jobs": [...]}.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        analysis = self.server.Analysis
+        if self.path == '/health':
+            self._Reply(200, {'ok':True})
+        elif self.path == '/stats':
+            self._Reply(200, analysis.RunJob({'op':'stats'}))
+        else:
+            self._Reply(404, {'ok':False, 'error':'Unknown path {0}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/batch':
+            self._Reply(404, {'ok':False, 'error':'Unknown path {0}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            jobs = request['jobs'] if isinstance(request, dict) else request
+        except (ValueError, KeyError) as e:
+            self._Reply(400, {'ok':False, 'error':'Bad request: {0}'.format(e)})
+            return
+        self._Reply(200, {'ok':True, 'results':self.server.Analysis.Run(jobs)})
+
+    def _Reply(self, code, obj):
+        body = json.dumps(obj, default=_JSONDefault).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        #Unix socket clients have no address.
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, fmt, *args):
+        _log.debug('%s %s', self.address_string(), fmt % args)
+
+
+def _JSONDefault(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{0} is not JSON serializable'.format(type(obj).__name__))
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.SocketPath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.SocketPath)
+
+
+def Request(jobs, address=('127.0.0.1', 8765), timeout=None):
+    '''
+    Send a batch of jobs to a running AnalysisServer and return the list of
+    results. address is a (host, port) pair or the path of a Unix socket.
+    '''
+    if isinstance(address, str):
+        _CheckUnixSockets()
+        conn = _UnixHTTPConnection(address, timeout)
+    else:
+        conn = http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+    try:
+        body = json.dumps({'jobs':jobs}, default=_JSONDefault)
+        conn.request('POST', '/batch', body, {'Content-Type':'application/json'})
+        reply = json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+    if not reply.get('ok'):
+        raise IOError(reply.get('error'))
+    return reply['results']
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the FluorSpec analysis server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', default=None,
+                        help='listen on this Unix socket instead of host:port '
+                        '(not on Windows)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cachesize', type=int, default=256,
+                        help='number of parsed (and of corrected) files to keep')
+    parser.add_argument('--basepath', default=None,
+                        help='directory containing correction_data')
+    parser.add_argument('--root', action='append', default=None,
+                        help='only read files under this directory (repeatable)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record stage timings (see FluorSpec.Metrics)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    reader = FluorSpec.Analyse.FluorSpecReader()
+    if args.basepath is not None:
+        reader.Basepath = os.path.join(args.basepath, '')
+        reader.CorrFiles = dict((key, None if path is None else path.replace('\\', os.sep))
+                                for key, path in reader.CorrFiles.items())
+    if args.metrics:
+        FluorSpec.Metrics.Enable()
+    server = AnalysisServer(reader, args.workers, args.cachesize, args.cachesize,
+                            args.root)
+    server.Serve(args.socket if args.socket is not None else (args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+'''
+Read very long Trace exports (e.g. kinetics runs) in fixed-size chunks, and
+summarise them in constant memory with streaming reducers.
+'''
+import itertools
+import numpy as np
+import FluorSpec.PTI_Data
+from FluorSpec.PTI_Data import _ParseBlock
+
+class TraceStream():
+    '''
+    Iterate over a Trace file in chunks of (WL, Trace) numpy arrays.
+
+    Only the header is read on construction (it is available as Header, a
+    lazily loaded PTI_Data object); each iteration reads the file again.
+    '''
+    def __init__(self, fname, chunksize=100000):
+        self.FilePath = fname
+        self.ChunkSize = chunksize
+        self.Header = FluorSpec.PTI_Data.PTI_Data(fname, lazy=True, quiet=True)
+        #Time based traces have a single Ex and Em wavelength, so their run
+        #type is Unknown and SuccessfullyRead is False; only the sample
+        #count is needed here.
+        if getattr(self.Header, 'FileType', None) != self.Header.FileTypes.Trace or \
+           not hasattr(self.Header, 'NumSamples'):
+            raise ValueError('{0} is not a readable Trace file: {1}'.format(
+                fname, self.Header.Messages))
+        self.NumSamples = self.Header.NumSamples
+
+    def __iter__(self):
+        start = self.Header.DataStartLine['Trace']
+        with open(self.FilePath, 'r') as thefile:
+            lines = itertools.islice(thefile, start, start + self.NumSamples)
+            while True:
+                chunk = list(itertools.islice(lines, self.ChunkSize))
+                if not chunk:
+                    return
+                block, counts = _ParseBlock(chunk)
+                yield block[:, 0].copy(), block[:, 1].copy()
+
+    def Reduce(self, *reducers):
+        '''
+        Feed every chunk to each of the reducers and return their results.
+        '''
+        for WL, trace in self:
+            for reducer in reducers:
+                reducer.Update(WL, trace)
+        return [reducer.Result() for reducer in reducers]
+
+
+class _BinReducer():
+    '''
+    Base for reducers over consecutive bins of binsize points. Points left
+    over at the end of a chunk are carried into the next one.
+    '''
+    def __init__(self, binsize):
+        self.BinSize = int(binsize)
+        self._WL = np.zeros(0)
+        self._Trace = np.zeros(0)
+        self._results = []
+
+    def Update(self, WL, trace):
+        WL = np.concatenate((self._WL, WL))
+        trace = np.concatenate((self._Trace, trace))
+        nfull = (len(WL)//self.BinSize)*self.BinSize
+        if nfull > 0:
+            self._results.append(self._Bins(WL[:nfull].reshape(-1, self.BinSize),
+                                            trace[:nfull].reshape(-1, self.BinSize)))
+        self._WL = WL[nfull:]
+        self._Trace = trace[nfull:]
+
+    def Result(self):
+        '''
+        The binned results so far, including the last partial bin.
+        '''
+        results = list(self._results)
+        if len(self._WL) > 0:
+            results.append(self._Bins(self._WL[None, :], self._Trace[None, :]))
+        if not results:
+            return self._Bins(np.zeros((0, 1)), np.zeros((0, 1)))
+        return tuple(np.concatenate(cols) for cols in zip(*results))
+
+
+class BinnedTrace(_BinReducer):
+    '''
+    Downsample a trace by averaging bins of binsize consecutive points.
+
+    Result() returns (WL, Trace, UTrace, N): the mean WL and mean counts of
+    each bin, the counting uncertainty of the mean and the number of points.
+    '''
+    def _Bins(self, WL, trace):
+        n = np.full(len(WL), WL.shape[1])
+        return (np.mean(WL, axis=1), np.mean(trace, axis=1),
+                np.sqrt(np.sum(np.abs(trace), axis=1))/n, n)
+
+
+class TraceEnvelope(_BinReducer):
+    '''
+    Min/max envelope of a trace, for plotting it with about npoints points.
+
+    Result() returns (WL, Min, Max): the first WL of each bin and the
+    minimum and maximum of the trace in it.
+    '''
+    def __init__(self, numsamples, npoints=2000):
+        _BinReducer.__init__(self, max(1, -(-numsamples//npoints)))
+
+    def _Bins(self, WL, trace):
+        return WL[:, 0], np.min(trace, axis=1), np.max(trace, axis=1)
+
+
+class RunningStats():
+    '''
+    Running count, mean, variance, minimum and maximum of a trace.
+
+    The statistics of each chunk are combined with those so far using the
+    pairwise (Chan et al.) update, which is numerically stable.
+    '''
+    def __init__(self):
+        self.N = 0
+        self.Mean = 0.
+        self._M2 = 0.
+        self.Min = np.inf
+        self.Max = -np.inf
+
+    def Update(self, WL, trace):
+        n = len(trace)
+        if n == 0:
+            return
+        mean = np.mean(trace)
+        M2 = np.sum(np.square(trace - mean))
+        delta = mean - self.Mean
+        total = self.N + n
+        self.Mean += delta*n/total
+        self._M2 += M2 + delta**2*self.N*n/total
+        self.N = total
+        self.Min = min(self.Min, np.min(trace))
+        self.Max = max(self.Max, np.max(trace))
+
+    def Variance(self, ddof=1):
+        if self.N - ddof <= 0:
+            return np.nan
+        return self._M2/(self.N - ddof)
+
+    def Result(self):
+        return {'N':self.N, 'mean':self.Mean, 'variance':self.Variance(),
+                'std':np.sqrt(self.Variance()), 'min':self.Min, 'max':self.Max}
@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+'''
+Watch a directory for new PTI exports and correct them as they arrive.
+'''
+import os
+import time
+import fnmatch
+import logging
+import threading
+import queue
+import numpy as np
+import FluorSpec.PTI_Data
+import FluorSpec.Analyse
+
+_log = logging.getLogger(__name__)
+
+class WatchFolder():
+    '''
+    Long-running ingest of the exports written to a directory.
+
+    The directory is polled every interval seconds. A file is taken to be
+    fully written once its size and mtime haven't changed for settle
+    seconds. It is then put on a bounded queue; a pool of worker threads
+    reads it, corrects it with FluorSpecReader.ApplyCorrFileToRaw and passes
+    the PTI_Data object (with the correction registered) to the output
+    callable. The reader's correction caches stay warm between files. When
+    the queue is full the poller waits, so a burst of files can't pile up
+    in memory. A file that is rewritten is processed again.
+    '''
+    def __init__(self, path, output, key, extracorr=None, bckgnd=0, factor=None,
+                 pattern='*.txt', interval=1., settle=2., workers=2, queuesize=64,
+                 reader=None, existing=True):
+        '''
+        Arguments:
+        - the directory to watch and the output callable (e.g. a CorrectedStore).
+        - the correction key, and the optional extracorr, bckgnd and factor, as
+          for FluorSpecReader.ApplyCorrFileToRaw.
+        - the filename pattern, polling interval and settle time (seconds).
+        - the number of worker threads and the size of the work queue.
+        - an optional FluorSpecReader to use (for its caches and Basepath).
+        - whether to process the files already in the directory.
+        '''
+        self.Path = path
+        self.Output = output
+        self.Key = key
+        self.ExtraCorr = extracorr
+        self.Bckgnd = bckgnd
+        self.Factor = factor
+        self.Pattern = pattern
+        self.Interval = interval
+        self.Settle = settle
+        self.Workers = workers
+        self.Reader = reader if reader is not None else FluorSpec.Analyse.FluorSpecReader()
+        self.Processed = 0
+        self.Failures = []
+        self._queue = queue.Queue(queuesize)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        #path -> (size, mtime, time first seen with that size and mtime)
+        self._pending = {}
+        #path -> (size, mtime) when it was queued
+        self._done = {}
+        if not existing:
+            for fname, st in self._Scan():
+                self._done[fname] = (st.st_size, st.st_mtime)
+
+    def Start(self):
+        '''
+        Start the poller and the workers in background threads.
+        '''
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._Work, daemon=True)
+                         for i in range(self.Workers)]
+        #The poller gets the number of workers to stop, as Stop(wait=False)
+        #forgets the threads before it finishes.
+        self._threads.append(threading.Thread(target=self._Poll, args=(self.Workers,),
+                                              daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def Stop(self, wait=True):
+        '''
+        Stop polling; the workers finish the files already queued.
+        '''
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def Run(self, duration=None):
+        '''
+        Watch in the foreground, for duration seconds or until interrupted.
+        '''
+        self.Start()
+        try:
+            if duration is None:
+                while True:
+                    time.sleep(self.Interval)
+            else:
+                time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        self.Stop()
+
+    def Stats(self):
+        with self._lock:
+            return {'processed':self.Processed, 'failed':len(self.Failures),
+                    'queued':self._queue.qsize(), 'pending':len(self._pending)}
+
+    def PollOnce(self):
+        '''
+        Scan the directory once and queue the files that have settled.
+        Blocks while the queue is full. Returns the number of files queued.
+        '''
+        now = time.time()
+        nqueued = 0
+        present = set()
+        for fname, st in self._Scan():
+            present.add(fname)
+            stamp = (st.st_size, st.st_mtime)
+            if self._done.get(fname) == stamp:
+                continue
+            seen = self._pending.get(fname)
+            if seen is None or seen[:2] != stamp:
+                self._pending[fname] = stamp + (now,)
+                continue
+            if now - seen[2] < self.Settle or now - st.st_mtime < self.Settle:
+                continue
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(fname, timeout=self.Interval)
+                    break
+                except queue.Full:
+                    pass
+            else:
+                return nqueued
+            del self._pending[fname]
+            self._done[fname] = stamp
+            nqueued += 1
+        #Forget the files that have gone (after a full scan only), so that a
+        #long running watch on a folder that's cleaned out doesn't grow.
+        for known in (self._pending, self._done):
+            for fname in [f for f in known if f not in present]:
+                del known[fname]
+        return nqueued
+
+    def _Scan(self):
+        for entry in os.scandir(self.Path):
+            if entry.is_file() and fnmatch.fnmatch(entry.name, self.Pattern):
+                yield entry.path, entry.stat()
+
+    def _Poll(self, nworkers):
+        try:
+            while not self._stop.is_set():
+                #Keep polling when the directory is briefly unavailable
+                #(e.g. a network share dropping out).
+                try:
+                    self.PollOnce()
+                except OSError as e:
+                    _log.warning("Could not scan %s: %s", self.Path, e)
+                self._stop.wait(self.Interval)
+        finally:
+            #Let each worker know there's nothing more to come.
+            for i in range(nworkers):
+                self._queue.put(None)
+
+    def _Work(self):
+        while True:
+            fname = self._queue.get()
+            if fname is None:
+                return
+            self.ProcessFile(fname)
+
+    def ProcessFile(self, fname):
+        '''
+        Read and correct one file and pass it to the output. Failures are
+        kept in the Failures list as (path, messages).
+        '''
+        try:
+            data = FluorSpec.PTI_Data.PTI_Data(fname, quiet=True)
+            if not data.SuccessfullyRead:
+                self._Fail(fname, data.Messages)
+                return
+            result = self.Reader.ApplyCorrFileToRaw(data, self.Key, bckgnd=self.Bckgnd,
+                                                    extracorr=self.ExtraCorr,
+                                                    factor=self.Factor)
+            if result is None:
+                self._Fail(fname, data.Messages + ['ERROR!! Correction failed.'])
+                return
+            self.Output(data)
+        except Exception as e:
+            self._Fail(fname, ['ERROR!! {0}: {1}'.format(type(e).__name__, e)])
+            return
+        with self._lock:
+            self.Processed += 1
+
+    def _Fail(self, fname, messages):
+        with self._lock:
+            self.Failures.append((fname, messages))
+
+
+class CorrectedStore():
+    '''
+    Output for WatchFolder: writes each corrected spectrum to a text file
+    (WL, SpecCorrected, USpecCorrected columns) in a directory, and appends
+    a line for it to index.txt there.
+    '''
+    def __init__(self, outdir):
+        self.OutDir = outdir
+        self._lock = threading.Lock()
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+    def __call__(self, data):
+        name = os.path.basename(data.FilePath)
+        outpath = os.path.join(self.OutDir, name + '.corrected.txt')
+        np.savetxt(outpath, np.column_stack((data.WL, data.SpecCorrected,
+                                             data.USpecCorrected)),
+                   delimiter='\t', header='WL\tSpecCorrected\tUSpecCorrected')
+        with self._lock:
+            with open(os.path.join(self.OutDir, 'index.txt'), 'a') as thefile:
+                thefile.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S'), data.FilePath, outpath,
+                    data.RunType.name, data.NumSamples))